@@ -1,156 +1,1412 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-import os
 import time
-from datetime import datetime
-import pytz
-from instagrapi import Client
-from dotenv import load_dotenv
+_startup_began = time.perf_counter()
+
+from flask import (Flask, render_template, request, redirect, url_for, session, jsonify, send_file, g,
+                   stream_with_context)
+from flask_socketio import SocketIO, Namespace, join_room, leave_room
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy.exc import IntegrityError
+import hashlib
+import os
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
 import json
 import threading
 import logging
+import uuid
+from models import (db, Thread, Participant, Message, ThreadHistory, ThreadGap, ThreadSummary, ThreadRead,
+                    OutboundMessage, Broadcast, BroadcastTarget, message_sort_key)
+from cache import SingleFlightCache
+from media_cache import MediaCache
+from thumbnails import ThumbnailRenderer, snap_width
+from formatter import (COMPACT_FIELDS, build_sender_map, compact_messages, epoch_seconds, extract_content,
+                       format_messages, format_threads, format_timestamp)
+from bus import SQLiteBus, open_bus
+from compression import compress, negotiate
+from search import ensure_search_index, search_messages
+from metrics import Registry, Counter, Histogram, Collected
+from presence import Presence
+from profiling import Profiler, current_trace, span
+from session_vault import SessionVault
+from client_pool import ClientPool
+from scheduler import PollScheduler, RateBudget
+from upstream import UpstreamExecutor, UpstreamTimeout
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
+# Load environment variables from the .env next to this file, wherever the app is started from
+ENV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
+if os.path.exists(ENV_FILE):
+    from dotenv import load_dotenv
+    load_dotenv(ENV_FILE)
+
+# Warn when importing the app takes longer than this
+STARTUP_TARGET_MS = int(os.getenv('STARTUP_TARGET_MS', 1000))
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)  # For session management
+os.makedirs(app.instance_path, exist_ok=True)
+
+def load_secret_key(path):
+    """The session signing key stored at path, created once so every worker and restart agrees on it."""
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(os.urandom(32))
+        os.chmod(tmp_path, 0o600)
+        try:
+            os.link(tmp_path, path)  # fails if another worker got there first
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+# Templates are static files; keep their compiled bytecode across restarts and workers
+TEMPLATE_CACHE_DIR = os.getenv('TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)}
+# Sessions are signed cookies, so any worker can read them as long as they share the key
+app.secret_key = os.getenv('SECRET_KEY') or load_secret_key(os.path.join(app.instance_path, 'secret_key'))
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///messages.db')
+db.init_app(app)
+with app.app_context():
+    db.create_all()
+    search_enabled = ensure_search_index(db.engine)
+socketio = SocketIO(app)
+
+# Socket.IO events and requests for background jobs travel over this bus. The default in-process bus
+# suits a single process. With EVENT_BUS=sqlite:///<path>, web workers only serve requests (RUN_POLLERS
+# defaults to 0) and one `flask run-pollers` process runs every poller, outbox and broadcast, publishing
+# their stats every STATS_INTERVAL seconds for the workers' /metrics and /api/poll/stats.
+bus = open_bus(os.getenv('EVENT_BUS'))
+RUN_POLLERS = os.getenv('RUN_POLLERS', '0' if isinstance(bus, SQLiteBus) else '1') == '1'
+if RUN_POLLERS and isinstance(bus, SQLiteBus):
+    logger.warning("RUN_POLLERS=1 with a shared EVENT_BUS: every worker will poll; use `flask run-pollers`")
+STATS_INTERVAL = int(os.getenv('STATS_INTERVAL', 5))
+
+active_polling_threads = {}  # username -> InboxPoller
+rate_budgets = {}  # username -> RateBudget
+polling_lock = threading.Lock()
+
+# Inbox polling settings: fast right after activity, normal while recent, slow when idle
+INBOX_POLL_INTERVAL = int(os.getenv('INBOX_POLL_INTERVAL', 10))
+POLL_FAST_INTERVAL = int(os.getenv('POLL_FAST_INTERVAL', 4))
+POLL_IDLE_INTERVAL = int(os.getenv('POLL_IDLE_INTERVAL', 60))
+POLL_ACTIVE_WINDOW = int(os.getenv('POLL_ACTIVE_WINDOW', 120))
+POLL_IDLE_AFTER = int(os.getenv('POLL_IDLE_AFTER', 900))
+INBOX_POLL_AMOUNT = int(os.getenv('INBOX_POLL_AMOUNT', 20))
+THREAD_LIST_AMOUNT = int(os.getenv('THREAD_LIST_AMOUNT', 50))  # threads fetched to seed the list
+ACCOUNT_REQUESTS_PER_MINUTE = int(os.getenv('ACCOUNT_REQUESTS_PER_MINUTE', 30))
+
+# Open pages send a heartbeat every HEARTBEAT_INTERVAL seconds. An account is polled only while it has
+# a view younger than PRESENCE_TTL, and only the threads on screen are synced.
+HEARTBEAT_INTERVAL = int(os.getenv('HEARTBEAT_INTERVAL', 20))
+PRESENCE_TTL = int(os.getenv('PRESENCE_TTL', 60))
+presence = Presence(ttl=PRESENCE_TTL)
+
+# One scheduler owns every account's poll job
+poll_scheduler = PollScheduler(max_workers=int(os.getenv('POLL_WORKERS', 4)))
+
+# Local message store settings
+MESSAGE_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+SEARCH_PAGE_SIZE = 20
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))  # smaller JSON is sent as is
+HISTORY_MAX_PAGES = 5  # upstream pages one history request may backfill
+SYNC_MAX_MESSAGES = int(os.getenv('SYNC_MAX_MESSAGES', 200))
+BUDGET_WAIT = float(os.getenv('BUDGET_WAIT', 5))  # seconds a request may wait for its account's rate budget
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 200))  # messages an export reads and formats at a time
+
+# Outgoing messages are queued and delivered in the background, spaced out per account. Queued
+# messages and broadcasts share the send settings below (see record_send_attempt).
+outboxes = {}  # username -> Outbox
+SEND_INTERVAL = float(os.getenv('SEND_INTERVAL', 1))  # seconds between one account's sends
+SEND_RETRY_DELAY = 5  # seconds before the first retry, doubling after each failure
+SEND_MAX_ATTEMPTS = int(os.getenv('SEND_MAX_ATTEMPTS', 5))
+SEND_TIMEOUT = float(os.getenv('SEND_TIMEOUT', 60))
+SEND_IDLE_INTERVAL = 60  # how often a job with nothing due looks for due retries
+
+# Broadcasts send one text to many threads, up to BROADCAST_CHUNK_SIZE of them per upstream call
+broadcast_jobs = {}  # broadcast id -> BroadcastJob
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', 25))
+BROADCAST_MAX_TARGETS = int(os.getenv('BROADCAST_MAX_TARGETS', 1000))
+
+# Saved Instagram sessions, one session_<username>.json per account
+session_vault = SessionVault(os.getenv('SESSION_DIR', '.'))
+
+# Every Instagram call runs here, so a slow one only holds a request for UPSTREAM_TIMEOUT
+upstream = UpstreamExecutor(
+    max_workers=int(os.getenv('UPSTREAM_WORKERS', 64)),
+    per_account=int(os.getenv('UPSTREAM_PER_ACCOUNT', 4)),
+    timeout=float(os.getenv('UPSTREAM_TIMEOUT', 15)),
+)
+
+# Upstream reads made within this many seconds of each other share one call
+upstream_cache = SingleFlightCache(ttl=float(os.getenv('UPSTREAM_CACHE_TTL', 3)))
+
+# Photos, videos and voice notes are proxied through /media and kept on disk, so
+# repeat views cost no upstream bandwidth and outlive the expiring CDN links
+media_cache = MediaCache(
+    os.getenv('MEDIA_CACHE_DIR', os.path.join(app.instance_path, 'media')),
+    max_bytes=int(os.getenv('MEDIA_CACHE_MAX_BYTES', 1024 ** 3)),
+)
+media_downloads = SingleFlightCache(ttl=0)  # one download per item, however many viewers ask
+MEDIA_MAX_AGE = 365 * 24 * 3600  # a message's media never changes
+
+# Photos are shown as thumbnails at a fixed width; the original only loads in the media modal
+thumbnail_renderer = ThumbnailRenderer(max_workers=int(os.getenv('THUMBNAIL_WORKERS', 2)))
+THUMBNAIL_WIDTH = int(os.getenv('THUMBNAIL_WIDTH', 320))
+
+# Prometheus metrics served at /metrics; METRICS_TOKEN, if set, is required as a bearer token
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+metrics = Registry()
+UPSTREAM_LATENCY = Histogram(metrics, 'instagram_upstream_seconds', 'Duration of Instagram API calls.', ['call'])
+UPSTREAM_ERRORS = Counter(metrics, 'instagram_upstream_errors_total', 'Instagram API calls that raised.', ['call'])
+UPSTREAM_TIMEOUTS = Counter(metrics, 'instagram_upstream_timeouts_total',
+                            'Instagram API calls the caller stopped waiting for.', ['call'])
+REQUEST_LATENCY = Histogram(metrics, 'http_request_seconds', 'Duration of Flask requests.', ['route', 'method'])
+REQUEST_COUNT = Counter(metrics, 'http_requests_total', 'Flask responses by status.', ['route', 'method', 'status'])
+POLL_BACKOFFS = Counter(metrics, 'poll_backoffs_total', 'Inbox polls that failed and backed off.')
+Collected(metrics, 'instagram_clients', 'Live Instagram clients in the pool.', lambda: len(instagram_clients))
+# Background job figures come from whichever process runs the jobs (see job_stats)
+Collected(metrics, 'inbox_pollers', 'Accounts with an inbox poller.', lambda: len(job_stats()['accounts']))
+Collected(metrics, 'live_views', 'Open pages and recent reads keeping pollers running.',
+          lambda: job_stats()['presence']['views'])
+Collected(metrics, 'scheduler_jobs', 'Jobs (polls, outboxes, broadcasts) on the scheduler.',
+          lambda: job_stats()['jobs'])
+Collected(metrics, 'scheduler_runs_total', 'Scheduler job runs.', lambda: job_stats()['runs'], 'counter')
+Collected(metrics, 'scheduler_errors_total', 'Scheduler job runs that raised.',
+          lambda: job_stats()['errors'], 'counter')
+Collected(metrics, 'scheduler_deferred_total', 'Job runs held back by an empty rate budget.',
+          lambda: job_stats()['deferred'], 'counter')
+Collected(metrics, 'upstream_in_flight', 'Instagram calls running now.', lambda: upstream.stats()['in_flight'])
+Collected(metrics, 'upstream_cache_total', 'Upstream cache lookups by result.',
+          lambda: {(k,): v for k, v in upstream_cache.stats().items() if k in ('hits', 'misses', 'coalesced')},
+          'counter', ['result'])
+Collected(metrics, 'media_cache_total', 'Media cache lookups by result.',
+          lambda: {(k,): v for k, v in media_cache.stats().items() if k in ('hits', 'misses')}, 'counter', ['result'])
+Collected(metrics, 'media_cache_bytes', 'Bytes of media on disk.', lambda: media_cache.stats()['total_bytes'])
+
+# Requests are profiled when they send X-Profile: <PROFILE_TOKEN>, or at random for PROFILE_SAMPLE_RATE
+# of them. Results go to PROFILE_DIR and are served at /debug/profiles with the token as a bearer.
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')
+profiler = Profiler(
+    os.getenv('PROFILE_DIR', os.path.join(app.instance_path, 'profiles')),
+    sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', 0)),
+    keep=int(os.getenv('PROFILE_KEEP', 200)),
+)
+
+def create_client(username):
+    """Build a client for the given user, restoring their saved session if any."""
+    # instagrapi is slow to import, so only pay for it once someone logs in
+    from instagrapi import Client
+    cl = Client()
+    cl.handle_exception = handle_client_exception
+    settings = session_vault.load(username)
+    if settings:
+        try:
+            cl.set_settings(settings)
+            cl.username = username
+        except Exception as e:
+            logger.info(f"Could not restore session for {username}: {e}")
+    return cl
 
-# Global client instance
-instagram_clients = {}
-active_polling_threads = {}
+def save_evicted_client(username, cl):
+    """Dump an evicted client's settings so it can be restored on the next request."""
+    if not cl.user_id:
+        return
+    try:
+        session_vault.save(username, cl.get_settings(), verified=False)
+        logger.info(f"Evicted client for {username}")
+    except Exception as e:
+        logger.error(f"Failed to save settings of evicted client {username}: {e}")
+
+# Instagram clients, bounded in number and dropped when idle
+instagram_clients = ClientPool(
+    create_client,
+    save_evicted_client,
+    max_size=int(os.getenv('CLIENT_POOL_SIZE', 50)),
+    idle_timeout=int(os.getenv('CLIENT_IDLE_TIMEOUT', 1800)),
+)
 
 def get_client_for_user(username):
     """Get or create an Instagram client for the given user."""
-    if username not in instagram_clients:
-        instagram_clients[username] = Client()
-    return instagram_clients[username]
-
-def format_timestamp(timestamp, local_timezone):
-    """Format the timestamp to show how long ago the message was sent."""
-    # Convert the timestamp to the local timezone
-    local_timestamp = timestamp.astimezone(local_timezone)
-    now = datetime.now(local_timezone)  # Current time in the local timezone
-    delta = now - local_timestamp
-    if delta.days > 0:
-        return f"{delta.days} day(s) ago"
-    elif delta.seconds >= 3600:
-        hours = delta.seconds // 3600
-        return f"{hours} hour(s) ago"
-    elif delta.seconds >= 60:
-        minutes = delta.seconds // 60
-        return f"{minutes} minute(s) ago"
+    cl = instagram_clients.get(username)
+    if not cl.user_id:
+        # Another worker may have logged in since this client was built
+        restore_saved_settings(cl, username)
+    return cl
+
+def restore_saved_settings(cl, username):
+    """Load the account's saved session into cl if it differs from the one cl has.
+
+    Returns True if it did; this is how a login or relogin in one process reaches the others.
+    """
+    settings = session_vault.load(username)
+    if not settings:
+        return False
+    try:
+        current = cl.get_settings()
+        if (settings.get('authorization_data') == current.get('authorization_data')
+                and settings.get('cookies') == current.get('cookies')):
+            return False
+        cl.set_settings(settings)
+        cl.username = username
+        return True
+    except Exception as e:
+        logger.info(f"Could not restore session for {username}: {e}")
+        return False
+
+def handle_client_exception(cl, e):
+    """instagrapi error hook: log in again when a real call finds the session expired.
+
+    Returning lets instagrapi retry the failed request once; raising gives up.
+    """
+    from instagrapi.exceptions import LoginRequired, ChallengeRequired
+
+    if isinstance(e, LoginRequired) and cl.username and cl.password:
+        logger.info(f"Session for {cl.username} expired, logging in again")
+        cl.relogin()
+        cl.relogin_attempt = 0
+        session_vault.save(cl.username, cl.get_settings(), cl.password)
+    elif isinstance(e, LoginRequired) and cl.username and restore_saved_settings(cl, cl.username):
+        # Another process logged in again since; retry with its session
+        logger.info(f"Session for {cl.username} expired, using the one saved by another worker")
+    elif isinstance(e, ChallengeRequired):
+        cl.challenge_resolve(cl.last_json)
     else:
-        return f"{delta.seconds} second(s) ago"
+        raise e
 
 def login_user(cl, username, password):
     """Attempts to login to Instagram."""
-    session_file = f"session_{username}.json"
+    settings = session_vault.load(username)
 
-    # Check if session file exists
-    if os.path.exists(session_file):
+    # Reuse the stored session as-is; it is only re-checked when a real call fails
+    if settings and session_vault.check_password(settings, password):
         try:
-            cl.load_settings(session_file)
-            cl.login(username, password)
-
-            # Check if session is valid
-            try:
-                cl.get_timeline_feed()
-                logger.info(f"Session loaded successfully for {username}")
+            cl.set_settings(settings)
+            if cl.user_id:
+                cl.username = username
+                cl.password = password
+                logger.info(f"Session restored for {username}")
                 return True
-            except Exception as e:
-                logger.info(f"Loaded session is invalid: {e}")
         except Exception as e:
             logger.info(f"Error loading session: {e}")
+    elif settings:
+        # Keep the stored device identity but not its login
+        cl.set_settings({**settings, 'authorization_data': {}, 'cookies': {}})
 
     # Login with username and password
     try:
         logger.info(f"Logging in to Instagram as {username}...")
-        cl.login(username, password)
+        with UPSTREAM_LATENCY.time(call='login'):
+            try:
+                cl.login(username, password)
+            except Exception:
+                UPSTREAM_ERRORS.inc(call='login')
+                raise
         # Save session for future use
-        cl.dump_settings(session_file)
+        session_vault.save(username, cl.get_settings(), password)
         logger.info(f"New session created and saved successfully.")
         return True
     except Exception as e:
         logger.error(f"Failed to login: {e}")
         return False
 
+def call_upstream(cl, fn, *args, cache_key=None, **kwargs):
+    """Run an Instagram call on the upstream executor, raising UpstreamTimeout if it is too slow.
+
+    A result that arrives after the caller gave up still fills the cache under cache_key.
+    """
+    on_late = (lambda value: upstream_cache.put(cache_key, value)) if cache_key else None
+    name = getattr(fn, '__name__', 'call')
+    trace = current_trace()
+
+    def timed(*call_args, **call_kwargs):
+        # A profiled request's trace follows the call onto the worker thread
+        with trace.active() if trace else nullcontext(), span('upstream.run', call=name), \
+                UPSTREAM_LATENCY.time(call=name):
+            try:
+                return fn(*call_args, **call_kwargs)
+            except Exception:
+                UPSTREAM_ERRORS.inc(call=name)
+                raise
+
+    try:
+        with span('upstream', call=name):
+            return upstream.call(cl.username, timed, *args, on_late=on_late, **kwargs)
+    except UpstreamTimeout:
+        UPSTREAM_TIMEOUTS.inc(call=name)
+        raise
+
 def fetch_threads(cl, amount=10):
     """Fetch the most recent threads from the inbox."""
+    key = (cl.username, 'threads', amount)
+
+    def load():
+        try:
+            return call_upstream(cl, cl.direct_threads, amount=amount, cache_key=key)
+        except Exception as e:
+            logger.error(f"Failed to fetch threads: {e}")
+            return None
+
+    return upstream_cache.get(key, load) or []
+
+def fetch_thread_page(cl, thread_id, cursor=None):
+    """Fetch one page of a thread (newest first) and the cursor of the next, older page."""
+    params = {
+        "visual_message_return_type": "unseen",
+        "direction": "older",
+        "seq_id": "40065",
+        "limit": str(MESSAGE_PAGE_SIZE),
+    }
+    if cursor:
+        params["cursor"] = cursor
+    key = (cl.username, 'thread', str(thread_id), 'page', cursor)
+
+    def direct_thread_page():
+        from instagrapi.extractors import extract_direct_thread
+        with span('private_request'):
+            result = cl.private_request(f"direct_v2/threads/{thread_id}/", params=params)
+        thread_data = result["thread"]
+        next_cursor = thread_data.get("oldest_cursor") if thread_data.get("has_older", True) else None
+        with span('extract_direct_thread'):
+            return extract_direct_thread(thread_data), next_cursor
+
+    def load():
+        try:
+            return call_upstream(cl, direct_thread_page, cache_key=key)
+        except Exception as e:
+            logger.error(f"Failed to fetch page of thread {thread_id}: {e}")
+            return None
+
+    return upstream_cache.get(key, load) or (None, None)
+
+def send_message(cl, thread_id, text, timeout=None):
+    """Send a message to a specific thread.
+
+    Returns the sent DirectMessage, False on failure, or None if the send is
+    still in flight when the timeout expires.
+    """
+    return send_to_many(cl, text, thread_ids=[thread_id], timeout=timeout)
+
+def send_to_many(cl, text, thread_ids=(), user_ids=(), timeout=None):
+    """Send one text to several threads, or to users, in a single call; returns as send_message does."""
+    targets = f"{len(thread_ids)} thread(s)" if thread_ids else f"{len(user_ids)} user(s)"
     try:
-        threads = cl.direct_threads(amount=amount)
-        return threads
+        sent = call_upstream(cl, cl.direct_send, text, thread_ids=list(thread_ids), user_ids=list(user_ids),
+                             timeout=timeout)
+        logger.info(f"Message sent to {targets}.")
+        return sent
+    except UpstreamTimeout as e:
+        logger.warning(f"Message to {targets} still sending: {e}")
+        return None
     except Exception as e:
-        logger.error(f"Failed to fetch threads: {e}")
-        return []
+        logger.error(f"Failed to send message to {targets}: {e}")
+        return False
 
-def fetch_thread_messages(cl, thread_id, amount=20):
-    """Fetch messages from a specific thread."""
+def fetch_media(url, key):
+    """Download url into the media cache under key; returns (path, digest, content_type).
+
+    Returns False if the CDN refused the link (its signature has expired) and None on other failures.
+    """
+    import requests
     try:
-        thread = cl.direct_thread(thread_id, amount=amount)
-        return thread
+        with requests.get(url, stream=True, timeout=upstream.timeout) as response:
+            if response.status_code in (403, 410):
+                logger.info(f"Media link for {key} was refused ({response.status_code}); it has likely expired")
+                return False
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', 'application/octet-stream')
+            return media_cache.store(key, response.iter_content(64 * 1024), content_type)
     except Exception as e:
-        logger.error(f"Failed to fetch messages for thread {thread_id}: {e}")
+        logger.error(f"Failed to fetch media for {key}: {e}")
         return None
 
-def send_message(cl, thread_id, text):
-    """Send a message to a specific thread."""
+def refresh_media_url(cl, username, stored):
+    """Look a stored message up upstream again for a fresh media link; returns it, or None.
+
+    Thread cursors are item ids, so the page of items older than id + 1 starts
+    with the message. The new link (and payload) is saved on the stored row.
+    """
+    if not stored.message_id.isdigit() or not get_rate_budget(username).acquire(timeout=BUDGET_WAIT):
+        return None
+    page, _ = fetch_thread_page(cl, stored.thread_id, str(int(stored.message_id) + 1))
+    msg = next((msg for msg in page.messages if msg.id == stored.message_id), None) if page else None
+    url = extract_content(msg)['media_url'] if msg else None
+    if url is None:
+        return None
+    stored.media_url = url
+    stored.payload = msg.model_dump(mode='json')
     try:
-        cl.direct_send(text, thread_ids=[thread_id])
-        logger.info(f"Message sent to thread {thread_id}.")
-        return True
+        db.session.commit()
     except Exception as e:
-        logger.error(f"Failed to send message: {e}")
-        return False
+        db.session.rollback()
+        logger.info(f"Skipped saving the new media link of message {stored.message_id}: {e}")
+    return url
+
+def download_media(username, stored, key):
+    """fetch_media for a stored message, fetching a fresh link first if its signed one has expired."""
+    cached = fetch_media(stored.media_url, key)
+    if cached is False:
+        url = refresh_media_url(get_client_for_user(username), username, stored)
+        cached = fetch_media(url, key) if url else None
+    return cached or None
+
+def fetch_thumbnail(original, key, width, image_format):
+    """Render and cache a thumbnail of a cached original; returns lookup()'s tuple or None."""
+    path, _, _ = original
+    try:
+        data = thumbnail_renderer.render(path, width, image_format, timeout=upstream.timeout)
+        return media_cache.store(key, [data], f"image/{image_format.lower()}")
+    except Exception as e:
+        logger.error(f"Failed to render thumbnail {key}: {e}")
+        return None
 
-class MessagePollingThread(threading.Thread):
-    """Thread for polling new messages in the background."""
+def proxied_media_url(message_id, width=None):
+    """Path the chat view loads a message's media (or its thumbnail at width) from."""
+    return f"/media/{message_id}?w={width}" if width else f"/media/{message_id}"
+
+def write_with_retry(apply, description):
+    """Run apply() and commit, retrying once if a concurrent writer inserted the same rows first."""
+    error = None
+    for attempt in range(2):
+        try:
+            apply()
+            db.session.commit()
+            return True
+        except IntegrityError as e:
+            db.session.rollback()
+            error = e
+    logger.info(f"Skipped {description}: {error}")
+    return False
+
+def store_thread(username, thread, messages, also=None):
+    """Save a thread, its participants and any new messages to the local store.
+
+    also(), if given, adds more rows in the same transaction, so a retry after a
+    concurrent insert writes them again rather than losing them to the rollback.
+    """
+    thread_id = str(thread.pk)
+
+    def apply():
+        stored = Thread.query.filter_by(account=username, thread_id=thread_id).first()
+        if stored is None:
+            stored = Thread(account=username, thread_id=thread_id)
+            db.session.add(stored)
+        stored.title = thread.thread_title
+        stored.is_group = thread.is_group
+        stored.last_activity_at = thread.last_activity_at
+        stored.synced_at = datetime.now()
+
+        known_users = {p.user_pk for p in Participant.query.filter_by(account=username, thread_id=thread_id)}
+        for user in thread.users:
+            if str(user.pk) not in known_users:
+                db.session.add(Participant(account=username, thread_id=thread_id,
+                                           user_pk=str(user.pk), username=user.username))
+
+        ids = [msg.id for msg in messages]
+        known_ids = {m.message_id for m in Message.query.filter(
+            Message.account == username, Message.thread_id == thread_id, Message.message_id.in_(ids))}
+        for msg in messages:
+            if msg.id in known_ids:
+                continue
+            content = extract_content(msg)
+            db.session.add(Message(
+                account=username,
+                thread_id=thread_id,
+                message_id=msg.id,
+                sort_key=message_sort_key(msg.id),
+                user_id=str(msg.user_id),
+                timestamp=msg.timestamp,
+                item_type=msg.item_type,
+                message_type=content['type'],
+                text=content['text'],
+                media_url=content['media_url'],
+                is_video=content['video'],
+                payload=msg.model_dump(mode='json'),
+            ))
+            if stored.newest_message_id is None or message_sort_key(msg.id) > message_sort_key(stored.newest_message_id):
+                stored.newest_message_id = msg.id
+        if also is not None:
+            also()
+
+    write_with_retry(apply, f"storing thread {thread_id} for {username}")
+
+def sync_thread(cl, username, thread_id, wait=0):
+    """Store the messages newer than the newest stored one; return how many were new.
+
+    Each upstream page is charged to the account's rate budget, waiting up to
+    wait seconds (forever if None) for it. A sync that stops before reaching
+    stored history (SYNC_MAX_MESSAGES, an empty budget or a failed page)
+    records the rest as a ThreadGap for history reads to fill.
+    """
+    thread_id = str(thread_id)
+    budget = get_rate_budget(username)
+    stored = Thread.query.filter_by(account=username, thread_id=thread_id).first()
+    newest_key = message_sort_key(stored.newest_message_id) if stored and stored.newest_message_id else None
+
+    thread = None
+    new_messages = []
+    cursor = None
+    reached_stored = newest_key is None
+    while True:
+        if not budget.acquire(timeout=wait):
+            break
+        page, next_cursor = fetch_thread_page(cl, thread_id, cursor)
+        if page is None:
+            break
+        cursor = next_cursor
+        thread = thread or page
+        fresh = [msg for msg in page.messages if newest_key is None or message_sort_key(msg.id) > newest_key]
+        new_messages.extend(fresh)
+        # A first sync takes only the newest page; later ones page back until stored history
+        if newest_key is None or len(fresh) < len(page.messages) or not cursor:
+            reached_stored = True
+            break
+        if len(new_messages) >= SYNC_MAX_MESSAGES:
+            break
+
+    if thread is None:
+        return None
 
-    def __init__(self, username, thread_id):
-        threading.Thread.__init__(self)
+    def record_history():
+        if newest_key is None and not ThreadHistory.query.filter_by(account=username, thread_id=thread_id).first():
+            # Remember where older history continues upstream
+            db.session.add(ThreadHistory(account=username, thread_id=thread_id,
+                                         oldest_cursor=cursor, has_older=cursor is not None))
+        if not reached_stored:
+            # cursor is the first page not fetched; everything from there down to newest_key is missing
+            db.session.add(ThreadGap(account=username, thread_id=thread_id, cursor=cursor, boundary_key=newest_key))
+
+    with span('store_thread', messages=len(new_messages)):
+        store_thread(username, thread, new_messages, also=record_history)
+    return len(new_messages)
+
+def update_thread_summaries(cl, username, threads):
+    """Upsert thread-list summaries from inbox threads (each carrying its newest message)."""
+    current_user_id = str(cl.user_id)
+
+    def apply():
+        reads = {read.thread_id: read.message_id for read in
+                 ThreadRead.query.filter(ThreadRead.account == username,
+                                         ThreadRead.thread_id.in_([str(thread.pk) for thread in threads]))}
+        for thread in threads:
+            thread_id = str(thread.pk)
+            summary = ThreadSummary.query.filter_by(account=username, thread_id=thread_id).first()
+            if summary is None:
+                summary = ThreadSummary(account=username, thread_id=thread_id)
+                db.session.add(summary)
+            summary.title = thread.thread_title
+            summary.participants = ", ".join(user.username for user in thread.users)
+            summary.last_message_at = thread.last_activity_at
+            summary.updated_at = datetime.now()
+
+            last_message = thread.messages[0] if thread.messages else None
+            if last_message:
+                content = extract_content(last_message)
+                summary.last_message_id = last_message.id
+                summary.last_message_text = content['text']
+                summary.last_message_type = content['type']
+                summary.last_message_at = last_message.timestamp
+
+            # Count what arrived after the newer of upstream's last seen item and the last one opened
+            # here; without either, the read flag means at least one
+            last_seen = (thread.last_seen_at or {}).get(current_user_id, {}).get('item_id')
+            read_here = reads.get(thread_id)
+            if read_here and (not last_seen or message_sort_key(read_here) > message_sort_key(last_seen)):
+                last_seen = read_here
+            if (not thread.read_state or (last_message and str(last_message.user_id) == current_user_id)
+                    or (last_message and last_seen
+                        and message_sort_key(last_message.id) <= message_sort_key(last_seen))):
+                summary.unread_count = 0
+            else:
+                # The inbox carries each thread's newest items, so this works for threads never synced
+                # and includes what arrived since the last sync; replying counts as reading
+                unread = 0
+                for msg in thread.messages:
+                    if str(msg.user_id) == current_user_id or (
+                            last_seen and message_sort_key(msg.id) <= message_sort_key(last_seen)):
+                        break
+                    unread += 1
+                else:
+                    # Every inbox item is unread: stored messages may show there are more
+                    if last_seen:
+                        stored = Message.query.filter(Message.account == username,
+                                                      Message.thread_id == thread_id,
+                                                      Message.user_id != current_user_id,
+                                                      Message.sort_key > message_sort_key(last_seen)).count()
+                        unread = max(unread, stored)
+                summary.unread_count = unread if last_seen else max(1, unread)
+
+    write_with_retry(apply, f"updating thread summaries for {username}")
+
+def mark_read(username, thread_id, message_id):
+    """Remember the account has seen a thread up to message_id and clear its unread count."""
+    def apply():
+        if message_id:
+            read = ThreadRead.query.filter_by(account=username, thread_id=thread_id).first()
+            if read is None:
+                db.session.add(ThreadRead(account=username, thread_id=thread_id, message_id=message_id))
+            elif message_sort_key(message_id) > message_sort_key(read.message_id):
+                read.message_id = message_id
+        ThreadSummary.query.filter_by(account=username, thread_id=thread_id).update({'unread_count': 0})
+
+    write_with_retry(apply, f"marking thread {thread_id} read for {username}")
+
+def history_gap(username, thread_id, before_key=None):
+    """The newest unfilled gap in a thread's stored history below before_key (or anywhere), or None."""
+    query = ThreadGap.query.filter_by(account=username, thread_id=thread_id)
+    if before_key:
+        query = query.filter(ThreadGap.boundary_key < before_key)
+    return query.order_by(ThreadGap.boundary_key.desc()).first()
+
+def stored_before(username, thread_id, before_key, gap):
+    """Stored messages older than before_key (all if None), newest first, stopping at gap.
+
+    Below a gap the store is not contiguous with what is above it, so nothing past it is returned.
+    """
+    query = Message.query.filter(Message.account == username, Message.thread_id == thread_id)
+    if before_key:
+        query = query.filter(Message.sort_key < before_key)
+    if gap is not None:
+        query = query.filter(Message.sort_key > gap.boundary_key)
+    return query.order_by(Message.sort_key.desc())
+
+def fill_gap(cl, username, gap):
+    """Fetch and store the next upstream page of a gap; returns False if the page could not be fetched.
+
+    The gap is deleted once its pages reach the messages stored below it.
+    """
+    page, cursor = fetch_thread_page(cl, gap.thread_id, gap.cursor)
+    if page is None:
+        return False
+    store_thread(username, page, page.messages)
+    if not cursor or any(message_sort_key(msg.id) <= gap.boundary_key for msg in page.messages):
+        db.session.delete(gap)
+    else:
+        gap.cursor = cursor
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.info(f"Skipped saving gap cursor of thread {gap.thread_id}: {e}")
+    return True
+
+def load_history(cl, username, thread_id, before, limit):
+    """Return up to limit messages older than before, newest first, and whether more exist.
+
+    Stored messages are served directly; upstream pages are only fetched (and
+    stored) when the store runs out, filling gaps left by capped syncs first.
+    """
+    thread_id = str(thread_id)
+    before_key = message_sort_key(before)
+
+    history = ThreadHistory.query.filter_by(account=username, thread_id=thread_id).first()
+    if history is None:
+        # Stored before history was tracked: page back from the newest page
+        history = ThreadHistory(account=username, thread_id=thread_id, oldest_cursor=None, has_older=True)
+        db.session.add(history)
+
+    budget = get_rate_budget(username)
+    deadline = time.monotonic() + BUDGET_WAIT
+    pages = 0
+    while True:
+        gap = history_gap(username, thread_id, before_key)
+        messages = stored_before(username, thread_id, before_key, gap).limit(limit + 1).all()
+        if len(messages) > limit or pages >= HISTORY_MAX_PAGES or (gap is None and not history.has_older):
+            break
+        # Serve what is stored rather than wait long for the account's budget
+        if not budget.acquire(timeout=max(0, deadline - time.monotonic())):
+            break
+        pages += 1
+        if gap is not None:
+            if not fill_gap(cl, username, gap):
+                break
+            continue
+        page, cursor = fetch_thread_page(cl, thread_id, history.oldest_cursor)
+        if page is None:
+            break
+        history.oldest_cursor = cursor
+        history.has_older = cursor is not None
+        store_thread(username, page, page.messages)
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.info(f"Skipped saving history cursor of thread {thread_id}: {e}")
+
+    has_more = len(messages) > limit or bool(history.has_older) or gap is not None
+    return messages[:limit], has_more
+
+def ndjson_line(record):
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+def export_thread(cl, username, thread_id, cursor=None):
+    """Yield a thread's whole history as NDJSON lines, newest message first, starting after cursor.
+
+    Stored messages are read a batch at a time; when they run out, or reach a
+    gap a capped sync left, older pages are fetched upstream (within the
+    account's rate budget) and stored, back to the start of the thread. The
+    closing "end" line's cursor resumes an export that stopped early.
+    """
+    thread_id = str(thread_id)
+    if Thread.query.filter_by(account=username, thread_id=thread_id).first() is None:
+        if sync_thread(cl, username, thread_id, wait=None) is None:
+            yield ndjson_line({'kind': 'end', 'thread_id': thread_id, 'messages': 0, 'complete': False,
+                               'cursor': cursor, 'error': 'Failed to fetch messages'})
+            return
+
+    current_user_id = str(cl.user_id)
+    participants = Participant.query.filter_by(account=username, thread_id=thread_id).all()
+    sender_map = build_sender_map(participants, current_user_id)
+    yield ndjson_line({'kind': 'thread', 'thread_id': thread_id,
+                       'users': [{'username': user.username, 'pk': user.user_pk} for user in participants]})
+
+    budget = get_rate_budget(username)
+    count = 0
+    error = None
+    while True:
+        before_key = message_sort_key(cursor) if cursor else None
+        gap = history_gap(username, thread_id, before_key)
+        batch = stored_before(username, thread_id, before_key, gap).limit(EXPORT_BATCH_SIZE).all()
+
+        if not batch and gap is not None:
+            # Messages a capped sync skipped come before anything stored below them
+            budget.acquire()
+            if not fill_gap(cl, username, gap):
+                error = 'Failed to fetch skipped messages'
+                break
+            continue
+
+        if not batch:
+            # The store is exhausted; backfill one older page from upstream, if there is one
+            history = ThreadHistory.query.filter_by(account=username, thread_id=thread_id).first()
+            if history is None:
+                history = ThreadHistory(account=username, thread_id=thread_id, oldest_cursor=None, has_older=True)
+                db.session.add(history)
+            if not history.has_older:
+                break
+            budget.acquire()
+            page, next_cursor = fetch_thread_page(cl, thread_id, history.oldest_cursor)
+            if page is None:
+                db.session.rollback()
+                error = 'Failed to fetch older messages'
+                break
+            history.oldest_cursor = next_cursor
+            history.has_older = next_cursor is not None
+            store_thread(username, page, page.messages)
+            try:
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.info(f"Skipped saving history cursor of thread {thread_id}: {e}")
+            continue
+
+        for message in format_messages(batch, sender_map, current_user_id, proxied_media_url):
+            yield ndjson_line({'kind': 'message', 'thread_id': thread_id, **message})
+        count += len(batch)
+        cursor = batch[-1].message_id
+        # Exported rows are not needed again; keeps memory flat however long the thread is
+        db.session.expunge_all()
+
+    end = {'kind': 'end', 'thread_id': thread_id, 'messages': count, 'complete': error is None, 'cursor': cursor}
+    if error:
+        end['error'] = error
+    yield ndjson_line(end)
+
+class InboxPoller:
+    """Poll job for one account while someone views it: diff its inbox and sync the viewed threads that changed."""
+
+    def __init__(self, username):
         self.username = username
-        self.thread_id = thread_id
-        self.stop_event = threading.Event()
-        self.last_message_id = None
-        self.daemon = True
+        self.key = username
+        self.budget = get_rate_budget(username)
+        self.lock = threading.Lock()
+        self.watched = set()  # threads with a live view as of the last cycle
+        self.inbox_state = {}  # thread_id -> (last_activity_at, newest message id)
+        self.synced = set()  # watched threads synced at least once
+        self.pending = set()  # watched threads that changed but are not synced yet
+        self.last_activity = time.monotonic()
+        self.backoff = None
+
+    def watch(self, thread_id):
+        """Include a thread in the refresh from now on; it stays in while it has a live view."""
+        with self.lock:
+            self.watched.add(str(thread_id))
+
+    @property
+    def expired(self):
+        return not presence.active(self.username)
+
+    def wake(self):
+        """Poll again now instead of waiting for the interval."""
+        self.last_activity = time.monotonic()
+        poll_scheduler.wake(self.key)
+
+    def push_new_messages(self, cl, arrivals):
+        """Emit the messages a sync stored to each thread's Socket.IO room; arrivals maps thread id -> after_id."""
+        threads = {}
+        participants = {}
+        for user in Participant.query.filter(Participant.account == self.username,
+                                             Participant.thread_id.in_(list(arrivals))):
+            participants.setdefault(user.thread_id, []).append(user)
+        for thread_id, after_id in arrivals.items():
+            query = Message.query.filter_by(account=self.username, thread_id=thread_id)
+            if after_id:
+                query = query.filter(Message.sort_key > message_sort_key(after_id))
+            messages = query.order_by(Message.sort_key.desc()).all()
+            if messages:
+                threads[thread_id] = (messages, participants.get(thread_id, []))
+
+        formatted = format_threads(threads, cl.user_id, proxied_media_url, THUMBNAIL_WIDTH)
+        for thread_id, (messages, _) in threads.items():
+            publish_to_room(chat_room(self.username, thread_id), 'messages',
+                            {'thread_id': thread_id, 'messages': formatted[thread_id]})
+            # Only watched threads are synced, so someone has this chat open and sees them arrive
+            mark_read(self.username, thread_id, messages[0].message_id)
+
+    def poll_once(self, cl):
+        """Diff the inbox once and sync the watched threads that changed, within budget."""
+        inbox = call_upstream(cl, cl.direct_threads, amount=INBOX_POLL_AMOUNT)
+
+        moved = []
+        with self.lock:
+            # Threads nobody has open drop out; if reopened they get a first pass again
+            self.watched = presence.threads(self.username)
+            self.synced &= self.watched
+            self.pending &= self.watched
+            for thread in inbox:
+                thread_id = str(thread.pk)
+                newest_id = thread.messages[0].id if thread.messages else None
+                state = (thread.last_activity_at, newest_id)
+                if self.inbox_state.get(thread_id) != state:
+                    self.inbox_state[thread_id] = state
+                    moved.append(thread)
+                    if thread_id in self.watched:
+                        self.pending.add(thread_id)
+            # Watched threads we have never synced need a first pass
+            self.pending.update(self.watched - self.synced)
+            changed = list(self.pending)
+
+        synced = []
+        arrivals = {}  # thread id -> newest message id before its sync
+        with app.app_context():
+            if moved:
+                update_thread_summaries(cl, self.username, moved)
+            for thread_id in changed:
+                # Threads left over when the budget runs out are synced next cycle; sync_thread
+                # charges each page it fetches
+                if not self.budget.available():
+                    break
+                # The inbox says this thread moved on, so cached pages of it are stale
+                upstream_cache.invalidate(self.username, 'thread', thread_id)
+                stored = Thread.query.filter_by(account=self.username, thread_id=thread_id).first()
+                newest_id = stored.newest_message_id if stored else None
+                new_count = sync_thread(cl, self.username, thread_id)
+                if new_count is None:
+                    continue
+                with self.lock:
+                    self.synced.add(thread_id)
+                    self.pending.discard(thread_id)
+                synced.append(thread_id)
+                if new_count:
+                    self.last_activity = time.monotonic()
+                    arrivals[thread_id] = newest_id
+            if arrivals:
+                self.push_new_messages(cl, arrivals)
+        return synced
+
+    def next_interval(self):
+        """Poll fast right after activity, at the normal pace for a while, then slowly."""
+        if self.pending:
+            return POLL_FAST_INTERVAL
+        quiet = time.monotonic() - self.last_activity
+        if quiet < POLL_ACTIVE_WINDOW:
+            return POLL_FAST_INTERVAL
+        if quiet < POLL_IDLE_AFTER:
+            return INBOX_POLL_INTERVAL
+        return POLL_IDLE_INTERVAL
 
     def run(self):
-        """Poll for new messages."""
-        polling_interval = 10  # Start with a 10-second interval
-        cl = get_client_for_user(self.username)
-
-        # Get initial message ID
+        """Poll once for the scheduler and return the delay until the next poll."""
+        if self.expired and stop_poller(self.username, self):
+            # The last viewer is gone; the next one starts a new poller
+            logger.info(f"No one is viewing {self.username}, stopped its poller")
+            return None
         try:
-            thread = fetch_thread_messages(cl, self.thread_id)
-            if thread and thread.messages:
-                self.last_message_id = thread.messages[0].id
+            # Looked up each cycle: the pool may have evicted and restored it
+            cl = get_client_for_user(self.username)
+            synced = self.poll_once(cl)
+            if synced:
+                logger.info(f"Refreshed {len(synced)} thread(s) for {self.username}")
+            self.backoff = None
+            # Come back by the time the last view expires, so a closed tab stops polling soon after
+            return min(self.next_interval(), presence.expires_in(self.username) + 1)
         except Exception as e:
-            logger.error(f"Error in initial message fetch: {e}")
+            logger.error(f"Error polling inbox for {self.username}: {e}")
+            # Handle rate limits
+            self.backoff = min((self.backoff or INBOX_POLL_INTERVAL) * 2, 300)
+            POLL_BACKOFFS.inc()
+            return self.backoff
 
-        while not self.stop_event.is_set():
-            try:
-                thread = fetch_thread_messages(cl, self.thread_id)
-                if thread and thread.messages and (self.last_message_id is None or thread.messages[0].id != self.last_message_id):
-                    self.last_message_id = thread.messages[0].id
-                    # Message updated, no need to refresh as client will poll
-                    polling_interval = 10
-            except Exception as e:
-                logger.error(f"Error fetching messages: {e}")
-                # Handle rate limits
-                polling_interval = min(polling_interval * 2, 300)
+    def stop(self):
+        """Stop polling this account."""
+        poll_scheduler.remove(self.key)
+
+def chat_room(username, thread_id):
+    """Socket.IO room shared by every view of one account's thread."""
+    return f"{username}:{thread_id}"
+
+def publish_to_room(room, event, data):
+    """Emit a Socket.IO event to a chat room from whichever process serves its sockets."""
+    bus.publish('socketio', {'room': room, 'event': event, 'data': data})
+
+def relay_event(payload):
+    socketio.emit(payload['event'], payload['data'], to=payload['room'], namespace='/chat')
+
+bus.subscribe('socketio', relay_event)
+
+def request_job(action, username, **params):
+    """Ask the process running background jobs to start or nudge one of this account's jobs."""
+    bus.publish('jobs', {'action': action, 'username': username, **params})
+
+def handle_job_request(payload):
+    """Carry out a request_job() in the process that runs the pollers."""
+    username = payload['username']
+    action = payload['action']
+    with app.app_context():
+        if action == 'view':
+            thread_id = payload.get('thread_id')
+            opened = presence.beat(username, payload['view_id'], thread_id)
+            poller = get_poller(username)
+            if thread_id:
+                poller.watch(thread_id)
+            # Only a newly opened view is activity; heartbeats of open ones would keep the pace fast forever
+            if opened:
+                poller.wake()
+        elif action == 'leave':
+            presence.leave(username, payload['view_id'])
+        elif action == 'wake_outbox':
+            get_outbox(username).wake()
+        elif action == 'start_broadcast':
+            start_broadcast(payload['broadcast_id'], username)
+        elif action == 'stop':
+            stop_jobs(username)
+        else:
+            logger.error(f"Unknown job request {action} for {username}")
+
+if RUN_POLLERS:
+    bus.subscribe('jobs', handle_job_request)
+
+def local_job_stats():
+    """Load and pace of the background jobs running in this process."""
+    with polling_lock:
+        pollers = list(active_polling_threads.values())
+        account_outboxes = list(outboxes.values())
+    viewers = presence.stats()['viewers']
+    return {
+        'jobs': len(poll_scheduler),
+        **poll_scheduler.stats,
+        'accounts': {
+            poller.username: {
+                'watched': len(poller.watched),
+                'viewers': viewers.get(poller.username, {}),
+                'pending': len(poller.pending),
+                'interval': poller.backoff or poller.next_interval(),
+                'budget_available': poller.budget.available(),
+            }
+            for poller in pollers
+        },
+        'outboxes': {outbox.username: dict(outbox.stats) for outbox in account_outboxes},
+        'presence': presence.stats(),
+    }
 
-            # Wait before polling again
-            for _ in range(polling_interval):
-                if self.stop_event.is_set():
-                    break
-                time.sleep(1)
+reported_job_stats = {}  # latest stats published by `flask run-pollers`, with when they arrived
+
+def receive_job_stats(payload):
+    reported_job_stats.update(stats=payload, received_at=time.time())
+
+if not RUN_POLLERS:
+    bus.subscribe('stats', receive_job_stats)
+
+def job_stats():
+    """Background job stats from this process if it runs the jobs, else the latest the poller process published.
+
+    'source' says which: "local", "run-pollers", or "missing" (no report for a few intervals), in
+    which case the figures are this process's own, i.e. empty.
+    """
+    if RUN_POLLERS:
+        return {**local_job_stats(), 'source': 'local'}
+    received_at = reported_job_stats.get('received_at')
+    if received_at is None or time.time() - received_at > 3 * STATS_INTERVAL:
+        return {**local_job_stats(), 'source': 'missing'}
+    return {**reported_job_stats['stats'], 'source': 'run-pollers', 'age': round(time.time() - received_at, 1)}
+
+def get_rate_budget(username):
+    """Get the upstream request budget shared by everything polling for the given user."""
+    with polling_lock:
+        budget = rate_budgets.get(username)
+        if budget is None:
+            budget = rate_budgets[username] = RateBudget(ACCOUNT_REQUESTS_PER_MINUTE)
+        return budget
+
+def get_poller(username):
+    """Get or start the inbox poller for the given user."""
+    with polling_lock:
+        poller = active_polling_threads.get(username)
+        if poller is not None:
+            return poller
+    poller = InboxPoller(username)
+    with polling_lock:
+        if username in active_polling_threads:
+            return active_polling_threads[username]
+        active_polling_threads[username] = poller
+    logger.info(f"Starting poller for {username}")
+    poll_scheduler.add(poller)
+    resume_outboxes(username)
+    resume_broadcasts(username)
+    return poller
+
+def outbound_status(outbound):
+    """What the chat view needs to render or update a queued message."""
+    return {
+        'key': outbound.idempotency_key,
+        'thread_id': outbound.thread_id,
+        'text': outbound.text,
+        'status': outbound.status,
+        'message_id': outbound.message_id,
+        'error': outbound.last_error,
+    }
+
+def record_send_attempt(row, sent, error_field):
+    """Count one send attempt on a queued OutboundMessage or BroadcastTarget and decide what comes next.
+
+    sent is the upstream result: truthy when sent, None on a timeout, falsy on an
+    error. The row's error text goes in error_field. Returns 'sent', 'retry' or 'failed'.
+    """
+    now = datetime.now()
+    row.attempts += 1
+    if sent:
+        row.status = 'sent'
+        row.sent_at = now
+        error, outcome = None, 'sent'
+    elif sent is None:
+        # It may still go through, so trying again could send it twice
+        row.status = 'failed'
+        error, outcome = 'Timed out; the message may have been sent', 'failed'
+    elif row.attempts >= SEND_MAX_ATTEMPTS:
+        row.status = 'failed'
+        error, outcome = 'Failed to send message', 'failed'
+    else:
+        delay = min(SEND_RETRY_DELAY * 2 ** (row.attempts - 1), 300)
+        row.next_attempt_at = now + timedelta(seconds=delay)
+        error, outcome = 'Failed to send message', 'retry'
+    setattr(row, error_field, error)
+    return outcome
+
+def next_send_delay(upcoming):
+    """Seconds until a send job should run again, given its next pending row (or None)."""
+    if upcoming is None:
+        return SEND_IDLE_INTERVAL
+    wait = (upcoming.next_attempt_at - datetime.now()).total_seconds()
+    return min(max(wait, SEND_INTERVAL), SEND_IDLE_INTERVAL)
+
+class Outbox:
+    """Scheduler job delivering one account's queued messages, one per run, within its rate budget.
+
+    It runs only while the account has queued messages; get_outbox starts it again for the next one.
+    """
+
+    def __init__(self, username):
+        self.username = username
+        self.key = ('outbox', username)
+        self.budget = None  # charged per send in run(), not per run
+        self.rate_budget = get_rate_budget(username)
+        self.stats = {'sent': 0, 'retries': 0, 'failed': 0}
+
+    def wake(self):
+        """Look for due messages now instead of waiting for the interval."""
+        poll_scheduler.wake(self.key)
+
+    def due(self):
+        """Queued messages that may be attempted now, oldest first."""
+        return (OutboundMessage.query
+                .filter(OutboundMessage.account == self.username,
+                        OutboundMessage.status == 'pending',
+                        OutboundMessage.next_attempt_at <= datetime.now())
+                .order_by(OutboundMessage.id.asc()))
+
+    def next_delay(self):
+        """Seconds until the next queued message is due, at least the send spacing."""
+        upcoming = (OutboundMessage.query
+                    .filter_by(account=self.username, status='pending')
+                    .order_by(OutboundMessage.next_attempt_at.asc())
+                    .first())
+        return next_send_delay(upcoming)
+
+    def deliver(self, cl, outbound):
+        """Send one queued message and record the outcome."""
+        sent = send_message(cl, outbound.thread_id, outbound.text, timeout=SEND_TIMEOUT)
+        outcome = record_send_attempt(outbound, sent, 'last_error')
+        if sent:
+            outbound.message_id = str(sent.id)
+        self.stats['retries' if outcome == 'retry' else outcome] += 1
+        db.session.commit()
+
+        publish_to_room(chat_room(self.username, outbound.thread_id), 'outbox', outbound_status(outbound))
+        if sent:
+            # Pick the sent message up right away rather than at the next interval
+            with polling_lock:
+                poller = active_polling_threads.get(self.username)
+            if poller:
+                poller.wake()
+
+    def run(self):
+        """Deliver the oldest due message and return the delay until the next run."""
+        with app.app_context():
+            outbound = self.due().first()
+            if outbound is not None:
+                if not self.rate_budget.try_acquire():
+                    return self.rate_budget.wait_time()
+                try:
+                    self.deliver(get_client_for_user(self.username), outbound)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error delivering queued message for {self.username}: {e}")
+            if not OutboundMessage.query.filter_by(account=self.username, status='pending').first():
+                self.retire()
+                return None
+            return self.next_delay()
+
+    def retire(self):
+        """Leave the scheduler once nothing is queued; a message queued meanwhile gets a new outbox."""
+        with polling_lock:
+            if outboxes.get(self.username) is self:
+                del outboxes[self.username]
+        self.stop()
+        # enqueue_message commits before it asks for an outbox, so a fresh read sees anything it missed
+        db.session.commit()
+        if OutboundMessage.query.filter_by(account=self.username, status='pending').first():
+            get_outbox(self.username)
 
     def stop(self):
-        """Stop the polling thread."""
-        self.stop_event.set()
+        """Stop delivering for this account; queued messages stay stored."""
+        poll_scheduler.remove(self.key)
+
+def get_outbox(username):
+    """Get or start the outbox for the given user."""
+    with polling_lock:
+        outbox = outboxes.get(username)
+        if outbox is not None:
+            return outbox
+    outbox = Outbox(username)
+    with polling_lock:
+        if username in outboxes:
+            return outboxes[username]
+        outboxes[username] = outbox
+    poll_scheduler.add(outbox, delay=0)
+    return outbox
+
+def enqueue_message(username, thread_id, text, key=None):
+    """Queue a message for delivery; a repeated idempotency key returns the first submission."""
+    key = key or uuid.uuid4().hex
+    existing = OutboundMessage.query.filter_by(account=username, idempotency_key=key).first()
+    if existing:
+        return existing
+
+    now = datetime.now()
+    outbound = OutboundMessage(account=username, thread_id=str(thread_id), idempotency_key=key, text=text,
+                               status='pending', attempts=0, next_attempt_at=now, created_at=now)
+    db.session.add(outbound)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The same draft was submitted twice at once
+        db.session.rollback()
+        return OutboundMessage.query.filter_by(account=username, idempotency_key=key).first()
+    request_job('wake_outbox', username)
+    return outbound
+
+class BroadcastJob:
+    """Scheduler job sending one broadcast a chunk per run, within the account's rate budget."""
+
+    def __init__(self, broadcast_id, username):
+        self.broadcast_id = broadcast_id
+        self.username = username
+        self.key = ('broadcast', broadcast_id)
+        self.budget = None  # charged per chunk in run(), not per run
+        self.rate_budget = get_rate_budget(username)
+
+    def next_chunk(self):
+        """Due targets for one call: many threads at once, but users one at a time.
+
+        A direct_send to several users would start a group chat with all of them.
+        Targets retried after a failed chunk also go alone, so one bad thread
+        cannot keep failing the rest.
+        """
+        due = (BroadcastTarget.query
+               .filter(BroadcastTarget.broadcast_id == self.broadcast_id,
+                       BroadcastTarget.status == 'pending',
+                       BroadcastTarget.next_attempt_at <= datetime.now())
+               .order_by(BroadcastTarget.id.asc()))
+        first = due.first()
+        if first is None or first.kind == 'user' or first.attempts:
+            return [first] if first else []
+        return (due.filter(BroadcastTarget.kind == 'thread', BroadcastTarget.attempts == 0)
+                .limit(BROADCAST_CHUNK_SIZE)
+                .all())
+
+    def deliver(self, cl, text, chunk):
+        """Send to one chunk of targets and record the outcome for each."""
+        ids = [target.target_id for target in chunk]
+        if chunk[0].kind == 'thread':
+            sent = send_to_many(cl, text, thread_ids=ids, timeout=SEND_TIMEOUT)
+        else:
+            sent = send_to_many(cl, text, user_ids=ids, timeout=SEND_TIMEOUT)
+        for target in chunk:
+            record_send_attempt(target, sent, 'error')
+        db.session.commit()
+
+    def run(self):
+        """Send the next chunk and return the delay until the next run, or finish the broadcast."""
+        with app.app_context():
+            broadcast = db.session.get(Broadcast, self.broadcast_id)
+            if broadcast is None or broadcast.status != 'running':
+                self.stop()
+                return None
+
+            chunk = self.next_chunk()
+            if chunk:
+                if not self.rate_budget.try_acquire():
+                    return self.rate_budget.wait_time()
+                try:
+                    self.deliver(get_client_for_user(self.username), broadcast.text, chunk)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error sending broadcast {self.broadcast_id} for {self.username}: {e}")
+
+            upcoming = (BroadcastTarget.query
+                        .filter_by(broadcast_id=self.broadcast_id, status='pending')
+                        .order_by(BroadcastTarget.next_attempt_at.asc())
+                        .first())
+            if upcoming is None:
+                broadcast.status = 'done'
+                broadcast.finished_at = datetime.now()
+                db.session.commit()
+                logger.info(f"Broadcast {self.broadcast_id} for {self.username} finished")
+                self.stop()
+                return None
+            return next_send_delay(upcoming)
+
+    def stop(self):
+        """Stop sending; targets not reached yet stay pending."""
+        poll_scheduler.remove(self.key)
+        with polling_lock:
+            broadcast_jobs.pop(self.broadcast_id, None)
+
+def start_broadcast(broadcast_id, username):
+    """Schedule a broadcast's job unless it is already running."""
+    job = BroadcastJob(broadcast_id, username)
+    with polling_lock:
+        if broadcast_id in broadcast_jobs:
+            return
+        broadcast_jobs[broadcast_id] = job
+    poll_scheduler.add(job, delay=0)
+
+def stop_poller(username, poller):
+    """Stop an inbox poller left without viewers; returns False if a viewer arrived or it was replaced."""
+    with polling_lock:
+        # A heartbeat is recorded before get_poller runs, so checking here cannot miss one
+        if active_polling_threads.get(username) is not poller or presence.active(username):
+            return False
+        del active_polling_threads[username]
+    poller.stop()
+    return True
+
+def stop_jobs(username):
+    """Stop the account's inbox poller and outbox; running broadcasts carry on."""
+    presence.forget(username)
+    with polling_lock:
+        poller = active_polling_threads.pop(username, None)
+        outbox = outboxes.pop(username, None)
+    if poller:
+        poller.stop()
+    if outbox:
+        outbox.stop()
+
+def resume_outboxes(username=None):
+    """Start the outbox of every account (or just username) with messages still queued from before a restart."""
+    query = db.session.query(OutboundMessage.account).filter(OutboundMessage.status == 'pending')
+    if username is not None:
+        query = query.filter(OutboundMessage.account == username)
+    for (account,) in query.distinct().all():
+        get_outbox(account)
+
+def resume_broadcasts(username):
+    """Pick up broadcasts that were still running when the app last stopped."""
+    for broadcast in Broadcast.query.filter_by(account=username, status='running').all():
+        start_broadcast(broadcast.id, username)
+
+@app.before_request
+def start_profile():
+    """Profile the request if it carries the admin header or is picked by sampling."""
+    forced = PROFILE_TOKEN and request.headers.get('X-Profile') == PROFILE_TOKEN
+    if forced or (profiler.sampled() and not request.path.startswith(('/debug/', '/static/', '/metrics'))):
+        g.profile = profiler.start(request.url_rule.rule if request.url_rule else 'unmatched')
+
+# Registered before the other after_request hooks so it runs last and includes them
+@app.after_request
+def finish_profile(response):
+    trace = g.pop('profile', None)
+    if trace is not None:
+        summary = profiler.finish(trace, method=request.method, path=request.full_path.rstrip('?'),
+                                  status=response.status_code)
+        response.headers['X-Profile-Id'] = summary['id']
+    return response
+
+@app.teardown_request
+def abandon_profile(error=None):
+    """Save the profile of a request that failed before its response was built."""
+    trace = g.pop('profile', None)
+    if trace is not None:
+        profiler.finish(trace, method=request.method, path=request.full_path.rstrip('?'), status=None,
+                        error=repr(error) if error else None)
+
+@app.before_request
+def start_request_timer():
+    g.request_began = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Time every request under its route pattern, so /chat/<thread_id> is one series."""
+    began = g.pop('request_began', None)
+    if began is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.observe(time.perf_counter() - began, route=route, method=request.method)
+        REQUEST_COUNT.inc(route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Gzip (or Brotli, if installed) larger JSON responses for clients that accept it."""
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.accept_encodings)
+    if encoding:
+        with span('compress', encoding=encoding, bytes=len(data)):
+            response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
 
 @app.route('/')
 def index():
@@ -182,19 +1438,16 @@ def logout():
     """Handle user logout."""
     username = session.get('username')
 
-    # Stop any active polling threads for this user
-    for thread_key in list(active_polling_threads.keys()):
-        if thread_key.startswith(f"{username}_"):
-            active_polling_threads[thread_key].stop()
-            del active_polling_threads[thread_key]
+    # Stop the inbox poller and outbox for this user
+    request_job('stop', username)
 
     # Logout from Instagram if client exists
-    if username in instagram_clients:
+    cl = instagram_clients.pop(username)
+    if cl:
         try:
-            instagram_clients[username].logout()
+            cl.logout()
         except:
             pass
-        del instagram_clients[username]
 
     # Clear session
     session.pop('username', None)
@@ -210,21 +1463,28 @@ def threads():
     username = session['username']
     cl = get_client_for_user(username)
 
-    # Fetch threads
-    threads_list = fetch_threads(cl)
+    # The inbox poller keeps the summaries current while the list is open; seed them on the first visit
+    request_job('view', username, view_id='request:inbox')
+    query = (ThreadSummary.query
+             .filter_by(account=username)
+             .order_by(ThreadSummary.last_message_at.desc()))
+    summaries = query.all()
+    if not summaries:
+        update_thread_summaries(cl, username, fetch_threads(cl, amount=THREAD_LIST_AMOUNT))
+        summaries = query.all()
 
     # Format threads for template
     formatted_threads = []
-    for thread in threads_list:
-        users = ", ".join([user.username for user in thread.users])
+    for summary in summaries:
         formatted_threads.append({
-            'id': thread.pk,
-            'users': users,
-            # # 'last_message': thread.last_permanent_item.text if hasattr(thread.last_permanent_item, 'text') and thread.last_permanent_item.text else "[Media or other content]",
-            # 'timestamp': thread.last_permanent_item.timestamp
+            'id': summary.thread_id,
+            'users': summary.participants,
+            'last_message': summary.last_message_text or "[Media or other content]",
+            'timestamp': format_timestamp(summary.last_message_at, timezone.utc) if summary.last_message_at else "",
+            'unread': summary.unread_count,
         })
 
-    return render_template('threads.html', threads=formatted_threads)
+    return render_template('threads.html', threads=formatted_threads, heartbeat_interval=HEARTBEAT_INTERVAL)
 
 @app.route('/chat/<thread_id>')
 def chat(thread_id):
@@ -234,14 +1494,10 @@ def chat(thread_id):
 
     username = session['username']
 
-    # Start polling thread if not already running
-    thread_key = f"{username}_{thread_id}"
-    if thread_key not in active_polling_threads:
-        polling_thread = MessagePollingThread(username, thread_id)
-        polling_thread.start()
-        active_polling_threads[thread_key] = polling_thread
+    # Have the account's inbox poller keep this thread fresh
+    request_job('view', username, view_id=f"request:{thread_id}", thread_id=str(thread_id))
 
-    return render_template('chat.html', thread_id=thread_id)
+    return render_template('chat.html', thread_id=thread_id, heartbeat_interval=HEARTBEAT_INTERVAL)
 
 @app.route('/api/messages/<thread_id>')
 def get_messages(thread_id):
@@ -251,107 +1507,234 @@ def get_messages(thread_id):
 
     username = session['username']
     cl = get_client_for_user(username)
-    current_user_id = cl.user_id
-
-    # Get timezone from request or use default
-    timezone_name = request.args.get('timezone', 'UTC')
-    local_timezone = pytz.timezone(timezone_name)
-
-    # Fetch thread
-    thread = fetch_thread_messages(cl, thread_id)
-    if not thread:
-        return jsonify({'error': 'Failed to fetch messages'}), 500
-
-    # Format messages
-    formatted_messages = []
-    for msg in thread.messages:
-        # Get sender username
-        if msg.user_id == current_user_id:
-            sender_username = "You"
-        else:
-            sender_username = "User"
-            for user in thread.users:
-                if user.pk == msg.user_id:
-                    sender_username = user.username
-                    break
-
-        # Format timestamp
-        time_ago = format_timestamp(msg.timestamp, local_timezone)
-
-        # Determine message type and content
-        message_data = {
-            'id': msg.id,
-            'sender': sender_username,
-            'timestamp': time_ago,
-            'is_current_user': msg.user_id == current_user_id,
-            'type': 'text'  # Default type
+    current_user_id = str(cl.user_id)
+
+    # Serve from the local store, syncing first if this thread was never stored
+    request_job('view', username, view_id=f"request:{thread_id}", thread_id=str(thread_id))
+    stored = Thread.query.filter_by(account=username, thread_id=str(thread_id)).first()
+    if stored is None:
+        with span('sync_thread'):
+            synced = sync_thread(cl, username, thread_id, wait=BUDGET_WAIT)
+        if synced is None:
+            return jsonify({'error': 'Failed to fetch messages'}), 500
+        stored = Thread.query.filter_by(account=username, thread_id=str(thread_id)).first()
+
+    limit = max(1, min(request.args.get('limit', MESSAGE_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    has_more = None
+    queued = None
+    etag = None
+    participants = Participant.query.filter_by(account=username, thread_id=stored.thread_id).all()
+
+    # Only return messages newer than the client's cursor, if it sent one
+    query = Message.query.filter_by(account=username, thread_id=stored.thread_id)
+    since = request.args.get('since')
+    before = request.args.get('before')
+    if since:
+        # Oldest first so a long gap is caught up over several requests without holes;
+        # has_more tells the client newer messages are still waiting
+        messages = (query.filter(Message.sort_key > message_sort_key(since))
+                    .order_by(Message.sort_key.asc())
+                    .limit(limit + 1)
+                    .all())
+        if not messages:
+            return '', 204
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        messages.reverse()
+        # The open chat is catching up, so these are on screen now
+        mark_read(username, stored.thread_id, messages[0].message_id)
+    elif before:
+        # Older history for infinite scroll
+        messages, has_more = load_history(cl, username, stored.thread_id, before, limit)
+    else:
+        # Opening the chat reads it, even if upstream is not told until the user replies
+        mark_read(username, stored.thread_id, stored.newest_message_id)
+
+        # Messages still queued (or given up on) are shown as such after a reload
+        queued = (OutboundMessage.query
+                  .filter(OutboundMessage.account == username,
+                          OutboundMessage.thread_id == stored.thread_id,
+                          OutboundMessage.status != 'sent')
+                  .order_by(OutboundMessage.id.asc())
+                  .all())
+        if any(outbound.status == 'pending' for outbound in queued):
+            request_job('wake_outbox', username)
+
+        # The first page only changes when a message arrives or the queue moves
+        newest = query.with_entities(Message.message_id).order_by(Message.sort_key.desc()).first()
+        etag = messages_etag(newest[0] if newest else None,
+                             [(outbound.id, outbound.status) for outbound in queued],
+                             [user.user_pk for user in participants],
+                             request.query_string)
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        messages = query.order_by(Message.sort_key.desc()).limit(limit + 1).all()
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if not has_more:
+            history = ThreadHistory.query.filter_by(account=username, thread_id=stored.thread_id).first()
+            has_more = history is None or bool(history.has_older)
+
+    sender_map = build_sender_map(participants, current_user_id)
+    thumbnail_width = snap_width(request.args.get('thumb', THUMBNAIL_WIDTH, type=int))
+    with span('format_messages', messages=len(messages)):
+        formatted_messages = format_messages(messages, sender_map, current_user_id, proxied_media_url,
+                                             thumbnail_width)
+
+    if request.args.get('format') == 'compact':
+        # Participants once, messages as rows pointing at them by index
+        with span('compact_messages'):
+            users, me, rows = compact_messages(messages, formatted_messages, participants, current_user_id)
+        response = {
+            'thread': {'id': stored.thread_id},
+            'users': users,
+            'me': me,
+            'fields': list(COMPACT_FIELDS),
+            'messages': rows,
+        }
+    else:
+        # Thread info
+        thread_info = {
+            'id': stored.thread_id,
+            'users': [{'username': user.username, 'pk': user.user_pk} for user in participants]
         }
 
-        # Check for different types of media content
-        if hasattr(msg, 'item_type'):
-            if msg.item_type == 'text':
-                message_data['type'] = 'text'
-                message_data['text'] = msg.text or ""
-            elif msg.item_type == 'media_share':
-                message_data['type'] = 'media_share'
-                if hasattr(msg, 'media_share') and hasattr(msg.media_share, 'thumbnail_url'):
-                    message_data['media_url'] = msg.media_share.thumbnail_url
-                    message_data['text'] = "[Shared Post]"
-            elif msg.item_type == 'media':
-                message_data['type'] = 'media'
-                # For images and videos sent directly
-                if hasattr(msg, 'visual_media') and hasattr(msg.visual_media, 'media'):
-                    media = msg.visual_media.media
-                    if hasattr(media, 'image_versions2'):
-                        # Get the best quality image
-                        candidates = media.image_versions2.candidates
-                        if candidates:
-                            message_data['media_url'] = candidates[0].url
-                            message_data['text'] = "[Photo]"
-                    elif hasattr(media, 'video_versions'):
-                        # Get video URL
-                        if media.video_versions:
-                            message_data['media_url'] = media.video_versions[0].url
-                            message_data['text'] = "[Video]"
-                            message_data['video'] = True
-            elif msg.item_type == 'voice_media':
-                message_data['type'] = 'voice'
-                message_data['text'] = "[Voice Message]"
-                if hasattr(msg, 'voice_media') and hasattr(msg.voice_media, 'media') and hasattr(msg.voice_media.media, 'audio'):
-                    message_data['media_url'] = msg.voice_media.media.audio.audio_src
-            elif msg.item_type == 'story_share':
-                message_data['type'] = 'story'
-                message_data['text'] = "[Shared Story]"
-            elif msg.item_type == 'reel_share':
-                message_data['type'] = 'reel'
-                message_data['text'] = "[Shared Reel]"
-            elif msg.item_type == 'clip':
-                message_data['type'] = 'clip'
-                message_data['text'] = "[Clip]"
-                if hasattr(msg, 'clip') and hasattr(msg.clip, 'media') and hasattr(msg.clip.media, 'video_versions'):
-                    message_data['media_url'] = msg.clip.media.video_versions[0].url
-                    message_data['video'] = True
-            else:
-                # For other types
-                message_data['type'] = 'other'
-                message_data['text'] = f"[{msg.item_type}]"
-        else:
-            # If no item_type attribute, default to text
-            message_data['text'] = msg.text or "[Media or other content]"
-
-        formatted_messages.append(message_data)
+        response = {
+            'thread': thread_info,
+            'messages': formatted_messages
+        }
+    if queued is not None:
+        response['outbox'] = [outbound_status(outbound) for outbound in queued]
+    if has_more is not None:
+        response['has_more'] = has_more
+
+    with span('jsonify'):
+        response = jsonify(response)
+    if etag:
+        response.set_etag(etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+def messages_etag(*state):
+    """Validator for a message list response built from the given state."""
+    return hashlib.sha1(repr(state).encode()).hexdigest()
+
+def parse_time(value):
+    """Naive local datetime, as instagrapi stores message times, from epoch seconds or ISO 8601."""
+    if not value:
+        return None
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value))
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+def sender_user_ids(username, sender, current_user_id):
+    """User pks a search's sender filter stands for: a pk, a username, or "me"."""
+    if sender.isdigit():
+        return [sender]
+    if sender.lower() in ('me', 'you'):
+        return [current_user_id]
+    participants = Participant.query.filter_by(account=username, username=sender).all()
+    return list({participant.user_pk for participant in participants})
+
+@app.route('/api/search')
+def search_api():
+    """API endpoint for full-text search over the account's stored messages, without upstream calls."""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    if not search_enabled:
+        return jsonify({'error': 'Search needs a SQLite database'}), 501
 
-    # Thread info
-    thread_info = {
-        'id': thread.pk,
-        'users': [{'username': user.username, 'pk': user.pk} for user in thread.users]
-    }
+    username = session['username']
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Search query cannot be empty'}), 400
+    try:
+        start = parse_time(request.args.get('start'))
+        end = parse_time(request.args.get('end'))
+    except ValueError:
+        return jsonify({'error': 'start and end must be ISO 8601 dates or epoch seconds'}), 400
+    limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+
+    current_user_id = str(get_client_for_user(username).user_id)
+    sender = request.args.get('sender')
+    user_ids = sender_user_ids(username, sender, current_user_id) if sender else None
+
+    began = time.perf_counter()
+    hits = search_messages(db.session, username, query, thread_id=request.args.get('thread_id'),
+                           user_ids=user_ids, start=start, end=end, limit=limit, offset=offset)
+    took_ms = (time.perf_counter() - began) * 1000
+
+    # Sender names, looked up once for all threads in the results
+    thread_ids = {hit['thread_id'] for hit in hits}
+    names = {(p.thread_id, p.user_pk): p.username for p in Participant.query.filter(
+        Participant.account == username, Participant.thread_id.in_(thread_ids))}
 
     return jsonify({
-        'thread': thread_info,
-        'messages': formatted_messages
+        'query': query,
+        'results': [
+            {
+                'thread_id': hit['thread_id'],
+                'message_id': hit['message_id'],
+                'sender': "You" if hit['user_id'] == current_user_id
+                          else names.get((hit['thread_id'], hit['user_id']), "User"),
+                'timestamp': epoch_seconds(hit['timestamp']) if hit['timestamp'] else None,
+                'snippet': hit['snippet'],
+                'rank': hit['rank'],
+            }
+            for hit in hits
+        ],
+        'took_ms': round(took_ms, 2),
     })
 
+@app.route('/api/export')
+@app.route('/api/export/<thread_id>')
+def export_api(thread_id=None):
+    """Stream the full history of one thread, or many, as NDJSON.
+
+    Without a thread id, ?thread_ids=1,2,3 picks the threads, defaulting to
+    every stored one. Each thread is a "thread" line, its messages newest first,
+    and an "end" line. ?cursor=<message id> resumes the first thread after that
+    message, so an interrupted archive restarts with the unfinished thread_ids.
+    """
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    username = session['username']
+    if thread_id:
+        thread_ids = [str(thread_id)]
+    elif request.args.get('thread_ids'):
+        thread_ids = list(dict.fromkeys(request.args['thread_ids'].split(',')))
+    else:
+        thread_ids = [thread.thread_id for thread in
+                      Thread.query.filter_by(account=username).with_entities(Thread.thread_id).all()]
+    if not all(i.isdigit() for i in thread_ids):
+        return jsonify({'error': 'Thread ids must be numeric'}), 400
+    cursor = request.args.get('cursor')
+    if cursor and not cursor.isdigit():
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    cl = get_client_for_user(username)
+
+    def generate():
+        for i, export_id in enumerate(thread_ids):
+            yield from export_thread(cl, username, export_id, cursor if i == 0 else None)
+
+    response = app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+    name = f"thread-{thread_id}" if thread_id else 'threads'
+    response.headers['Content-Disposition'] = f'attachment; filename="{name}.ndjson"'
+    response.headers['X-Accel-Buffering'] = 'no'  # let proxies pass lines on as they come
+    return response
+
 @app.route('/api/send/<thread_id>', methods=['POST'])
 def send_message_api(thread_id):
     """API endpoint to send a message."""
@@ -359,601 +1742,316 @@ def send_message_api(thread_id):
         return jsonify({'error': 'Not logged in'}), 401
 
     username = session['username']
-    cl = get_client_for_user(username)
 
     # Get message text from request
     data = request.get_json()
     message_text = data.get('message', '').strip()
+    key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
 
     if not message_text:
         return jsonify({'error': 'Message cannot be empty'}), 400
+    if key and len(key) > 64:
+        return jsonify({'error': 'Idempotency key is too long'}), 400
 
-    # Send the message
-    if send_message(cl, thread_id, message_text):
-        return jsonify({'success': True})
-    else:
-        return jsonify({'error': 'Failed to send message'}), 500
-
-# Create the HTML templates directory
-os.makedirs('templates', exist_ok=True)
-
-# Create HTML templates
-with open('templates/login.html', 'w') as f:
-    f.write('''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Instagram DM - Login</title>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/bootstrap/5.3.0/css/bootstrap.min.css">
-    <style>
-        body {
-            background-color: #fafafa;
-            padding-top: 60px;
-        }
-        .login-container {
-            max-width: 350px;
-            padding: 20px;
-            background-color: white;
-            border-radius: 5px;
-            box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-        }
-        .logo {
-            text-align: center;
-            margin-bottom: 20px;
-            font-family: 'Billabong', cursive;
-            font-size: 35px;
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="row justify-content-center">
-            <div class="login-container">
-                <div class="logo">Instagram DM</div>
-                {% if error %}
-                <div class="alert alert-danger">{{ error }}</div>
-                {% endif %}
-                <form method="POST" action="/login">
-                    <div class="mb-3">
-                        <input type="text" class="form-control" name="username" placeholder="Username" required>
-                    </div>
-                    <div class="mb-3">
-                        <input type="password" class="form-control" name="password" placeholder="Password" required>
-                    </div>
-                    <button type="submit" class="btn btn-primary w-100">Log In</button>
-                </form>
-                <div class="mt-3 text-center text-muted small">
-                    <p>This web app is for personal use only. It uses your credentials securely.</p>
-                </div>
-            </div>
-        </div>
-    </div>
-</body>
-</html>
-''')
-
-with open('templates/threads.html', 'w') as f:
-    f.write('''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Instagram DM - Conversations</title>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/bootstrap/5.3.0/css/bootstrap.min.css">
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta3/css/all.min.css">
-    <style>
-        body {
-            background-color: #fafafa;
-        }
-        .thread-list {
-            background-color: white;
-            border-radius: 5px;
-            box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-        }
-        .thread-item {
-            border-bottom: 1px solid #efefef;
-            padding: 15px;
-            cursor: pointer;
-        }
-        .thread-item:hover {
-            background-color: #f9f9f9;
-        }
-        .thread-item:last-child {
-            border-bottom: none;
-        }
-        .thread-title {
-            font-weight: bold;
-        }
-        .thread-preview {
-            color: #8e8e8e;
-            white-space: nowrap;
-            overflow: hidden;
-            text-overflow: ellipsis;
-        }
-        .thread-time {
-            font-size: 0.8rem;
-            color: #8e8e8e;
-        }
-        .navbar {
-            background-color: white;
-            box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-        }
-    </style>
-</head>
-<body>
-    <nav class="navbar navbar-expand-lg navbar-light fixed-top">
-        <div class="container">
-            <a class="navbar-brand" href="/threads">Instagram DM</a>
-            <button class="navbar-toggler" type="button" data-bs-toggle="collapse" data-bs-target="#navbarNav">
-                <span class="navbar-toggler-icon"></span>
-            </button>
-            <div class="collapse navbar-collapse" id="navbarNav">
-                <ul class="navbar-nav ms-auto">
-                    <li class="nav-item">
-                        <a class="nav-link" href="/logout"><i class="fas fa-sign-out-alt"></i> Logout</a>
-                    </li>
-                </ul>
-            </div>
-        </div>
-    </nav>
-
-    <div class="container" style="padding-top: 70px;">
-        <h4 class="mb-3">Direct Messages</h4>
-
-        <div class="thread-list">
-            {% if threads %}
-                {% for thread in threads %}
-                <div class="thread-item" onclick="window.location.href='/chat/{{ thread.id }}'">
-                    <div class="d-flex justify-content-between">
-                        <div class="thread-title">{{ thread.users }}</div>
-                        <div class="thread-time"></div>
-                    </div>
-                    <div class="thread-preview">{{ thread.last_message }}</div>
-                </div>
-                {% endfor %}
-            {% else %}
-                <div class="text-center p-4 text-muted">
-                    <p>No conversations found</p>
-                </div>
-            {% endif %}
-        </div>
-    </div>
-
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/bootstrap/5.3.0/js/bootstrap.bundle.min.js"></script>
-</body>
-</html>
-''')
-
-with open('templates/chat.html', 'w') as f:
-    f.write('''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Instagram DM - Chat</title>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/bootstrap/5.3.0/css/bootstrap.min.css">
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta3/css/all.min.css">
-    <style>
-        body {
-            background-color: #fafafa;
-            height: 100vh;
-            margin: 0;
-            display: flex;
-            flex-direction: column;
-        }
-        .navbar {
-            background-color: white;
-            box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-            position: fixed;
-            top: 0;
-            left: 0;
-            right: 0;
-            z-index: 1000;
-        }
-        .chat-container {
-            flex: 1;
-            display: flex;
-            flex-direction: column;
-            padding-top: 56px; /* Height of the navbar */
-            padding-bottom: 70px; /* Height of the input container */
-            overflow: hidden;
-        }
-        .message-list {
-            flex: 1;
-            overflow-y: auto;
-            padding: 15px;
-            display: flex;
-            flex-direction: column;
-        }
-        .message {
-            max-width: 75%;
-            margin-bottom: 10px;
-            padding: 10px 15px;
-            border-radius: 15px;
-            position: relative;
-            word-wrap: break-word;
-        }
-        .message.outgoing {
-            background-color: #007AFF; /* iMessage blue */
-            color: white;
-            align-self: flex-end;
-            margin-left: auto;
-            border-bottom-right-radius: 5px; /* Sharp edge on bottom right */
-        }
-        .message.incoming {
-            background-color: #E5E5EA; /* Light grey */
-            color: black;
-            align-self: flex-start;
-            margin-right: auto;
-            border-bottom-left-radius: 5px; /* Sharp edge on bottom left */
-        }
-        .message-sender {
-            font-weight: bold;
-            font-size: 0.8rem;
-            margin-bottom: 2px;
-        }
-        .message-time {
-            font-size: 0.7rem;
-            color: #8e8e8e;
-            margin-top: 2px;
-            text-align: right;
-        }
-        .outgoing .message-time {
-            color: rgba(255, 255, 255, 0.8);
-        }
-        .message-media {
-            max-width: 100%;
-            max-height: 300px;
-            border-radius: 5px;
-            margin-top: 5px;
-            cursor: pointer;
-        }
-        .message-video {
-            max-width: 100%;
-            max-height: 300px;
-            border-radius: 5px;
-            margin-top: 5px;
-        }
-        .media-container {
-            position: relative;
-        }
-        .media-play-button {
-            position: absolute;
-            top: 50%;
-            left: 50%;
-            transform: translate(-50%, -50%);
-            color: white;
-            background-color: rgba(0, 0, 0, 0.5);
-            border-radius: 50%;
-            padding: 10px;
-            font-size: 20px;
-        }
-        .message-input-container {
-            background-color: white;
-            border-top: 1px solid #dbdbdb;
-            padding: 10px;
-            position: fixed;
-            bottom: 0;
-            left: 0;
-            right: 0;
-            z-index: 1000;
-        }
-        .message-input {
-            border-radius: 20px;
-            padding: 10px 50px 10px 15px;
-            resize: none;
-            width: 100%;
-            border: 1px solid #dbdbdb;
-            outline: none;
-            line-height: 1.5;
-        }
-        .send-button {
-            position: absolute;
-            right: 25px;
-            bottom: 18px; /* Adjusted to align with input */
-            background: none;
-            border: none;
-            color: #007AFF;
-            font-size: 18px;
-            cursor: pointer;
-            padding: 0;
-            margin: 0;
-        }
-        .loading-spinner {
-            display: none;
-            text-align: center;
-            padding: 20px;
-        }
-        /* Media Preview Modal */
-        .media-modal {
-            display: none;
-            position: fixed;
-            z-index: 1050;
-            left: 0;
-            top: 0;
-            width: 100%;
-            height: 100%;
-            overflow: auto;
-            background-color: rgba(0,0,0,0.9);
-        }
-        .media-modal-content {
-            margin: auto;
-            display: block;
-            max-width: 90%;
-            max-height: 90vh;
-        }
-        .close-modal {
-            position: absolute;
-            top: 15px;
-            right: 35px;
-            color: #f1f1f1;
-            font-size: 40px;
-            font-weight: bold;
-            cursor: pointer;
-        }
-    </style>
-</head>
-<body>
-    <nav class="navbar navbar-expand-lg navbar-light">
-        <div class="container">
-            <a class="navbar-brand" href="/threads"><i class="fas fa-arrow-left"></i> Back</a>
-            <span id="chat-title" class="navbar-text">Loading...</span>
-            <button class="navbar-toggler" type="button" data-bs-toggle="collapse" data-bs-target="#navbarNav">
-                <span class="navbar-toggler-icon"></span>
-            </button>
-            <div class="collapse navbar-collapse" id="navbarNav">
-                <ul class="navbar-nav ms-auto">
-                    <li class="nav-item">
-                        <a class="nav-link" href="#" id="refresh-btn"><i class="fas fa-sync-alt"></i> Refresh</a>
-                    </li>
-                </ul>
-            </div>
-        </div>
-    </nav>
-
-    <div class="chat-container">
-        <div class="message-list" id="messageList">
-            <div class="loading-spinner" id="loadingSpinner">
-                <div class="spinner-border text-primary" role="status">
-                    <span class="visually-hidden">Loading...</span>
-                </div>
-            </div>
-        </div>
-    </div>
-
-    <div class="message-input-container">
-        <div class="container position-relative">
-            <form id="messageForm">
-                <textarea class="form-control message-input" id="messageInput" placeholder="Message..." rows="1"></textarea>
-                <button type="submit" class="send-button"><i class="fas fa-paper-plane"></i></button>
-            </form>
-        </div>
-    </div>
-
-    <!-- Media Preview Modal -->
-    <div id="mediaModal" class="media-modal">
-        <span class="close-modal">&times;</span>
-        <img class="media-modal-content" id="mediaPreview">
-        <video class="media-modal-content" id="videoPreview" controls style="display:none;"></video>
-    </div>
-
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/bootstrap/5.3.0/js/bootstrap.bundle.min.js"></script>
-    <script>
-        // Get the thread ID from the URL
-        const threadId = '{{ thread_id }}';
-        let lastMessageId = null;
-
-        // Get user's timezone
-        const timezone = Intl.DateTimeFormat().resolvedOptions().timeZone;
-
-        // Function to load messages
-        function loadMessages() {
-            document.getElementById('loadingSpinner').style.display = 'block';
-
-            fetch(`/api/messages/${threadId}?timezone=${encodeURIComponent(timezone)}`)
-                .then(response => response.json())
-                .then(data => {
-                    if (data.error) {
-                        console.error(data.error);
-                        return;
-                    }
-
-                    // Update the chat title
-                    const users = data.thread.users.map(user => user.username).join(', ');
-                    document.getElementById('chat-title').textContent = users;
-
-                    // Clear messages if first load or if we have a new message
-                    const messageList = document.getElementById('messageList');
-                    if (!lastMessageId || (data.messages.length > 0 && data.messages[0].id !== lastMessageId)) {
-                        // Keep the spinner element
-                        const spinner = document.getElementById('loadingSpinner');
-                        messageList.innerHTML = '';
-                        messageList.appendChild(spinner);
-
-                        // Update lastMessageId if we have messages
-                        if (data.messages.length > 0) {
-                            lastMessageId = data.messages[0].id;
-                        }
-
-                        // Reverse the messages array to show newest at the bottom
-                        const sortedMessages = [...data.messages].reverse();
-
-                        // Add messages
-                        sortedMessages.forEach(message => {
-                            const messageDiv = document.createElement('div');
-                            messageDiv.className = `message ${message.is_current_user ? 'outgoing' : 'incoming'}`;
-                            messageDiv.dataset.messageId = message.id;
-
-                            if (!message.is_current_user) {
-                                const senderDiv = document.createElement('div');
-                                senderDiv.className = 'message-sender';
-                                senderDiv.textContent = message.sender;
-                                messageDiv.appendChild(senderDiv);
-                            }
-
-                            const textDiv = document.createElement('div');
-                            textDiv.className = 'message-text';
-                            textDiv.textContent = message.text;
-                            messageDiv.appendChild(textDiv);
-
-                            // Handle media content
-                            if (message.type !== 'text' && message.media_url) {
-                                if (message.video) {
-                                    // For video content
-                                    const videoElement = document.createElement('video');
-                                    videoElement.className = 'message-video';
-                                    videoElement.src = message.media_url;
-                                    videoElement.controls = true;
-                                    videoElement.style.maxWidth = '100%';
-                                    videoElement.style.maxHeight = '300px';
-                                    videoElement.style.borderRadius = '5px';
-                                    videoElement.style.marginTop = '5px';
-                                    messageDiv.appendChild(videoElement);
-                                } else {
-                                    // For image content
-                                    const mediaImg = document.createElement('img');
-                                    mediaImg.className = 'message-media';
-                                    mediaImg.src = message.media_url;
-                                    mediaImg.alt = 'Media';
-                                    mediaImg.style.maxWidth = '100%';
-                                    mediaImg.style.maxHeight = '300px';
-                                    mediaImg.style.borderRadius = '5px';
-                                    mediaImg.style.marginTop = '5px';
-                                    mediaImg.onclick = function() { openMediaModal(message.media_url, false); };
-                                    messageDiv.appendChild(mediaImg);
-                                }
-                            }
-
-                            const timeDiv = document.createElement('div');
-                            timeDiv.className = 'message-time';
-                            timeDiv.textContent = message.timestamp;
-                            messageDiv.appendChild(timeDiv);
-
-                            messageList.appendChild(messageDiv);
-                        });
-
-                        // Scroll to the bottom
-                        messageList.scrollTop = messageList.scrollHeight;
-                    }
-                })
-                .catch(error => {
-                    console.error('Error loading messages:', error);
-                })
-                .finally(() => {
-                    document.getElementById('loadingSpinner').style.display = 'none';
-                });
-        }
+    # Queue the message; it is delivered in the background
+    outbound = enqueue_message(username, thread_id, message_text, key)
+    return jsonify({'success': True, **outbound_status(outbound)}), 202
 
-        // Function to open media preview modal
-        function openMediaModal(src, isVideo) {
-            const modal = document.getElementById('mediaModal');
-            const imagePreview = document.getElementById('mediaPreview');
-            const videoPreview = document.getElementById('videoPreview');
-
-            if (isVideo) {
-                imagePreview.style.display = 'none';
-                videoPreview.style.display = 'block';
-                videoPreview.src = src;
-                videoPreview.play();
-            } else {
-                imagePreview.style.display = 'block';
-                videoPreview.style.display = 'none';
-                imagePreview.src = src;
+@app.route('/api/broadcast', methods=['POST'])
+def broadcast_api():
+    """API endpoint to send one message to many threads or users in the background."""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    username = session['username']
+    data = request.get_json() or {}
+    message_text = (data.get('message') or '').strip()
+    targets = []
+    for kind, field in (('thread', 'thread_ids'), ('user', 'user_ids')):
+        ids = data.get(field) or []
+        if not isinstance(ids, list) or not all(str(i).isdigit() for i in ids):
+            return jsonify({'error': f'{field} must be a list of numeric ids'}), 400
+        targets.extend((kind, target_id) for target_id in dict.fromkeys(str(i) for i in ids))
+
+    if not message_text:
+        return jsonify({'error': 'Message cannot be empty'}), 400
+    if not targets:
+        return jsonify({'error': 'No thread_ids or user_ids given'}), 400
+    if len(targets) > BROADCAST_MAX_TARGETS:
+        return jsonify({'error': f'At most {BROADCAST_MAX_TARGETS} targets per broadcast'}), 400
+
+    now = datetime.now()
+    broadcast = Broadcast(account=username, text=message_text, status='running', created_at=now)
+    db.session.add(broadcast)
+    db.session.flush()
+    db.session.add_all(BroadcastTarget(broadcast_id=broadcast.id, kind=kind, target_id=target_id,
+                                       status='pending', attempts=0, next_attempt_at=now)
+                       for kind, target_id in targets)
+    db.session.commit()
+    request_job('start_broadcast', username, broadcast_id=broadcast.id)
+
+    return jsonify({
+        'id': broadcast.id,
+        'status': broadcast.status,
+        'targets': len(targets),
+        'status_url': url_for('broadcast_status', broadcast_id=broadcast.id),
+    }), 202
+
+@app.route('/api/broadcast/<int:broadcast_id>')
+def broadcast_status(broadcast_id):
+    """API endpoint reporting a broadcast's progress and each target's outcome."""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    broadcast = db.session.get(Broadcast, broadcast_id)
+    if broadcast is None or broadcast.account != session['username']:
+        return jsonify({'error': 'Broadcast not found'}), 404
+
+    targets = BroadcastTarget.query.filter_by(broadcast_id=broadcast_id).order_by(BroadcastTarget.id.asc()).all()
+    counts = {'pending': 0, 'sent': 0, 'failed': 0}
+    for target in targets:
+        counts[target.status] += 1
+
+    return jsonify({
+        'id': broadcast.id,
+        'status': broadcast.status,
+        'created_at': broadcast.created_at.isoformat() if broadcast.created_at else None,
+        'finished_at': broadcast.finished_at.isoformat() if broadcast.finished_at else None,
+        'counts': counts,
+        'targets': [
+            {
+                'kind': target.kind,
+                'id': target.target_id,
+                'status': target.status,
+                'attempts': target.attempts,
+                'error': target.error,
             }
+            for target in targets
+        ],
+    })
 
-            modal.style.display = 'flex';
-        }
+@app.route('/media/<message_id>')
+def media(message_id):
+    """Serve a message's photo, video or voice note from the media cache, with Range support.
 
-        // Function to close the modal
-        function closeMediaModal() {
-            const modal = document.getElementById('mediaModal');
-            const videoPreview = document.getElementById('videoPreview');
+    ?w=<width> serves a photo as a thumbnail at the nearest fixed width instead.
+    """
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
 
-            modal.style.display = 'none';
-            videoPreview.pause();
-        }
+    username = session['username']
+    key = f"{username}:{message_id}"
+    width = request.args.get('w', type=int)
+    # A blob evicted between its lookup and send_file is a miss: look it up, and fetch it, again
+    for _ in range(2):
+        cached = media_cache.lookup(key)
+        if cached is None:
+            stored = Message.query.filter_by(account=username, message_id=str(message_id)).first()
+            if stored is None or not stored.media_url:
+                return jsonify({'error': 'Media not found'}), 404
+            cached = media_downloads.get((key,), lambda: download_media(username, stored, key))
+            if cached is None:
+                return jsonify({'error': 'Failed to fetch media'}), 502
+
+        # Thumbnails are cached per width and format next to their original
+        if width and cached[2].startswith('image/'):
+            thumb_width = snap_width(width)
+            image_format = thumbnail_renderer.image_format('image/webp' in request.headers.get('Accept', ''))
+            thumb_key = f"{key}@{thumb_width}.{image_format.lower()}"
+            original = cached
+            cached = media_cache.lookup(thumb_key) or media_downloads.get(
+                (thumb_key,), lambda: fetch_thumbnail(original, thumb_key, thumb_width, image_format))
+            if cached is None:
+                cached = original
+
+        path, digest, content_type = cached
+        try:
+            # conditional=True answers Range and If-None-Match requests, so seeking works
+            response = send_file(path, mimetype=content_type, conditional=True, etag=digest, max_age=MEDIA_MAX_AGE)
+            break
+        except FileNotFoundError:
+            logger.info(f"Media {key} was evicted while being served; fetching it again")
+    else:
+        return jsonify({'error': 'Failed to fetch media'}), 502
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept')
+    return response
+
+@app.route('/api/cache/stats')
+def cache_stats():
+    """API endpoint reporting upstream cache hits and misses."""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
 
-        // Function to send a message
-        function sendMessage(messageText) {
-            fetch(`/api/send/${threadId}`, {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    message: messageText
-                })
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.error) {
-                    console.error(data.error);
-                    return;
-                }
-
-                // Clear the input
-                document.getElementById('messageInput').value = '';
-
-                // Load the messages to show the sent message
-                setTimeout(loadMessages, 1000);
-            })
-            .catch(error => {
-                console.error('Error sending message:', error);
-            });
-        }
+    return jsonify({
+        **upstream_cache.stats(),
+        'upstream': upstream.stats(),
+        'media': media_cache.stats(),
+        'thumbnails': thumbnail_renderer.stats(),
+    })
+
+@app.route('/api/heartbeat', methods=['POST'])
+def heartbeat():
+    """Keep a page without a socket (the thread list) counted as a viewer, or end its view."""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    data = request.get_json(silent=True) or {}
+    view_id = str(data.get('view_id') or '')
+    if not view_id or len(view_id) > 64:
+        return jsonify({'error': 'view_id is required'}), 400
+    if data.get('leave'):
+        request_job('leave', session['username'], view_id=f"page:{view_id}")
+    else:
+        thread_id = str(data['thread_id']) if data.get('thread_id') else None
+        request_job('view', session['username'], view_id=f"page:{view_id}", thread_id=thread_id)
+    return '', 204
+
+@app.route('/api/poll/stats')
+def poll_stats():
+    """API endpoint reporting the poll scheduler's load and each account's pace."""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    return jsonify({**job_stats(), 'bus': bus.stats()})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint."""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+def profiles_authorized():
+    return PROFILE_TOKEN and request.headers.get('Authorization') == f"Bearer {PROFILE_TOKEN}"
+
+@app.route('/debug/profiles')
+def profiles_list():
+    """Recent request profiles, newest first."""
+    if not profiles_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({
+        'profiles': profiler.summaries(limit=request.args.get('limit', 50, type=int)),
+        'sample_rate': profiler.sample_rate,
+        'saved': profiler.saved,
+    })
+
+@app.route('/debug/profiles/<profile_id>')
+def profile_detail(profile_id):
+    """Spans and the hottest functions of one profile."""
+    if not profiles_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
+    profile = profiler.load(profile_id)
+    if profile is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return jsonify(profile)
+
+@app.route('/debug/profiles/<profile_id>.<any(prof, folded):extension>')
+def profile_download(profile_id, extension):
+    """The cProfile dump (.prof) or flame graph stacks (.folded) of one profile."""
+    if not profiles_authorized():
+        return jsonify({'error': 'Unauthorized'}), 401
+    path = profiler.path(profile_id, extension)
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(path, as_attachment=True, download_name=f"{profile_id}.{extension}",
+                     mimetype='application/octet-stream' if extension == 'prof' else 'text/plain')
+
+@app.route('/api/clients/stats')
+def client_stats():
+    """API endpoint reporting live Instagram clients and their approximate memory."""
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    instagram_clients.evict_idle()
+    return jsonify(instagram_clients.stats())
+
+class ChatNamespace(Namespace):
+    """Socket.IO namespace pushing new messages to open chat views."""
+
+    def on_connect(self):
+        """Only accept logged-in users."""
+        if 'username' not in session:
+            return False
+
+    def on_disconnect(self, reason=None):
+        """A closed tab stops counting as a viewer right away."""
+        if 'username' in session:
+            request_job('leave', session['username'], view_id=request.sid)
+
+    def on_join(self, data):
+        """Subscribe this view to a thread's room."""
+        username = session['username']
+        thread_id = str(data.get('thread_id'))
+        join_room(chat_room(username, thread_id))
+        request_job('view', username, view_id=request.sid, thread_id=thread_id)
+
+    def on_heartbeat(self, data):
+        """The view is still open; sent every HEARTBEAT_INTERVAL seconds."""
+        request_job('view', session['username'], view_id=request.sid, thread_id=str(data.get('thread_id')))
+
+    def on_leave(self, data):
+        """Unsubscribe this view from a thread's room."""
+        leave_room(chat_room(session['username'], str(data.get('thread_id'))))
+        request_job('leave', session['username'], view_id=request.sid)
+
+    def on_send(self, data):
+        """Queue a message; the return value is the client's acknowledgement."""
+        username = session['username']
+        thread_id = str(data.get('thread_id'))
+        message_text = (data.get('message') or '').strip()
+        key = data.get('idempotency_key')
+
+        if not message_text:
+            return {'error': 'Message cannot be empty'}
+        if key and len(key) > 64:
+            return {'error': 'Idempotency key is too long'}
+
+        outbound = enqueue_message(username, thread_id, message_text, key)
+        return {'success': True, **outbound_status(outbound)}
+
+socketio.on_namespace(ChatNamespace('/chat'))
+
+@app.cli.command('precompile-templates')
+def precompile_templates():
+    """Compile every template into the bytecode cache ahead of the first request."""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+        print(f"Compiled {name}")
+
+@app.cli.command('run-pollers')
+def run_pollers():
+    """Run every account's pollers, outboxes and broadcasts for web workers started with RUN_POLLERS=0."""
+    if not isinstance(bus, SQLiteBus):
+        raise SystemExit("Set EVENT_BUS (e.g. sqlite:///instance/events.db) to the web workers' bus")
+    if not RUN_POLLERS:
+        bus.subscribe('jobs', handle_job_request)
+        with app.app_context():
+            resume_outboxes()
+    logger.info(f"Running pollers for requests on {bus.path}")
+    try:
+        while True:
+            # Web workers read these for /metrics and /api/poll/stats
+            try:
+                bus.publish('stats', local_job_stats())
+            except Exception as e:
+                logger.error(f"Error publishing job stats: {e}")
+            time.sleep(STATS_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+if RUN_POLLERS:
+    # Queued messages go out after a restart even if nobody opens the account again
+    with app.app_context():
+        resume_outboxes()
+
+startup_ms = (time.perf_counter() - _startup_began) * 1000
+if startup_ms > STARTUP_TARGET_MS:
+    logger.warning(f"App started in {startup_ms:.0f} ms, over the {STARTUP_TARGET_MS} ms target")
+else:
+    logger.info(f"App started in {startup_ms:.0f} ms")
 
-        // Initialize the chat
-        document.addEventListener('DOMContentLoaded', function() {
-            // Load messages initially
-            loadMessages();
-
-            // Set up polling for new messages
-            setInterval(loadMessages, 10000);
-
-            // Set up the form submission
-            document.getElementById('messageForm').addEventListener('submit', function(e) {
-                e.preventDefault();
-
-                const messageInput = document.getElementById('messageInput');
-                const messageText = messageInput.value.trim();
-
-                if (messageText) {
-                    sendMessage(messageText);
-                }
-            });
-
-            // Set up the refresh button
-            document.getElementById('refresh-btn').addEventListener('click', function(e) {
-                e.preventDefault();
-                loadMessages();
-            });
-
-            // Make textarea expand with content
-            const messageInput = document.getElementById('messageInput');
-            messageInput.addEventListener('input', function() {
-                this.style.height = 'auto';
-                this.style.height = (this.scrollHeight) + 'px';
-            });
-
-            // Set up modal close event
-            document.querySelector('.close-modal').addEventListener('click', closeMediaModal);
-
-            // Close modal when clicking outside of content
-            document.getElementById('mediaModal').addEventListener('click', function(e) {
-                if (e.target === this) {
-                    closeMediaModal();
-                }
-            });
-        });
-    </script>
-</body>
-</html>
-''')
-
-# Main entry point
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=8000, debug=True)
+    socketio.run(app, host='0.0.0.0', port=8000, debug=True)
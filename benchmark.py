@@ -0,0 +1,365 @@
+"""Repeatable benchmarks of app.py against a fake Instagram, no account needed.
+
+    python benchmark.py                                   # every scenario
+    python benchmark.py messages threads --iterations 500
+    python benchmark.py --latency 0.2 --error-rate 0.05   # slow, flaky upstream
+    python benchmark.py --compare bench_results/<earlier run>.json
+
+get_client_for_user is swapped for one returning FakeClient instances, and
+app.py runs against a scratch database. Results are written as JSON under
+bench_results/ (or --output) so runs can be compared between releases.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fake_instagram import FakeClient
+
+SCENARIOS = ('messages', 'threads', 'polling', 'send', 'broadcast')
+
+
+def summarize(samples):
+    """Latency percentiles in milliseconds for a list of durations in seconds."""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def load_app(workdir, args):
+    """Import app.py against scratch storage, with the per-account limits opened up for load."""
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'SESSION_DIR': os.path.join(workdir, 'sessions'),
+        'MEDIA_CACHE_DIR': os.path.join(workdir, 'media'),
+        'TEMPLATE_CACHE_DIR': os.path.join(workdir, 'jinja_cache'),
+        'ACCOUNT_REQUESTS_PER_MINUTE': str(args.requests_per_minute),
+        'SEND_INTERVAL': '0',
+    })
+    import app
+    logging.getLogger().setLevel(logging.WARNING)
+    return app
+
+
+class Bench:
+    """Fake clients per account plus logged-in test clients for driving the routes."""
+
+    def __init__(self, app, args):
+        self.app = app
+        self.args = args
+        self.lock = threading.Lock()
+        self.fakes = {}
+        app.get_client_for_user = self.client
+
+    def client(self, username):
+        with self.lock:
+            fake = self.fakes.get(username)
+            if fake is None:
+                fake = self.fakes[username] = FakeClient(
+                    username=username,
+                    threads=self.args.threads,
+                    messages=self.args.messages,
+                    participants=self.args.participants,
+                    media_mix=self.args.media_mix,
+                    latency=self.args.latency,
+                    error_rate=self.args.error_rate,
+                    seed=self.args.seed,
+                )
+            return fake
+
+    def http(self, username):
+        """A test client with username logged in."""
+        http = self.app.app.test_client()
+        with http.session_transaction() as flask_session:
+            flask_session['username'] = username
+        return http
+
+    def upstream_calls(self):
+        with self.lock:
+            fakes = list(self.fakes.values())
+        return sum(sum(fake.calls.values()) for fake in fakes)
+
+    def run_concurrently(self, username, requests, concurrency):
+        """Run (method, url, json) requests on concurrency threads; returns durations and status counts."""
+        durations = []
+        statuses = {}
+        lock = threading.Lock()
+        local = threading.local()
+
+        def one(request):
+            if not hasattr(local, 'http'):
+                local.http = self.http(username)
+            method, url, body = request
+            began = time.perf_counter()
+            response = local.http.open(url, method=method, json=body)
+            elapsed = time.perf_counter() - began
+            with lock:
+                durations.append(elapsed)
+                statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+        began = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, requests))
+        return durations, statuses, time.perf_counter() - began
+
+
+def scenario_messages(bench, args):
+    """First (cold) and repeated (warm) loads of /api/messages across threads."""
+    username = 'bench-messages'
+    http = bench.http(username)
+    thread_ids = list(bench.client(username).threads)
+    cold, warm, statuses = [], [], {}
+    calls_before = bench.upstream_calls()
+    for i in range(args.iterations):
+        thread_id = thread_ids[i % len(thread_ids)]
+        began = time.perf_counter()
+        response = http.get(f"/api/messages/{thread_id}?format=compact")
+        (cold if i < len(thread_ids) else warm).append(time.perf_counter() - began)
+        statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+    return {
+        'cold': summarize(cold),
+        'warm': summarize(warm),
+        'statuses': statuses,
+        'upstream_calls': bench.upstream_calls() - calls_before,
+    }
+
+
+def scenario_threads(bench, args):
+    """Throughput of the thread list under concurrent requests."""
+    username = 'bench-threads'
+    bench.http(username).get('/threads')  # seed the summary index
+    requests = [('GET', '/threads', None)] * args.iterations
+    durations, statuses, elapsed = bench.run_concurrently(username, requests, args.concurrency)
+    return {
+        'latency': summarize(durations),
+        'requests_per_second': round(len(durations) / elapsed, 1),
+        'statuses': statuses,
+    }
+
+
+def scenario_polling(bench, args):
+    """Many open chats polling for new messages while the inbox keeps receiving them."""
+    username = 'bench-polling'
+    fake = bench.client(username)
+    thread_ids = list(fake.threads)[:args.chats]
+    stop = threading.Event()
+    durations, statuses, received = [], {}, {}
+    lock = threading.Lock()
+
+    def chat(thread_id):
+        http = bench.http(username)
+        data = http.get(f"/api/messages/{thread_id}").get_json() or {}
+        newest = (data.get('messages') or [{}])[0].get('id')
+        seen = 0
+        while not stop.is_set():
+            began = time.perf_counter()
+            url = f"/api/messages/{thread_id}" + (f"?since={newest}" if newest else '')
+            response = http.get(url)
+            elapsed = time.perf_counter() - began
+            if response.status_code == 200:
+                messages = response.get_json()['messages']
+                if messages:
+                    newest = messages[0]['id']
+                    seen += len(messages)
+            with lock:
+                durations.append(elapsed)
+                statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+            stop.wait(args.poll_interval)
+        with lock:
+            received[thread_id] = seen
+
+    def feed():
+        for n in itertools.count():
+            if stop.wait(1 / args.incoming_rate):
+                return
+            fake.receive(thread_ids[n % len(thread_ids)], f"incoming {n}")
+
+    chats = [threading.Thread(target=chat, args=(thread_id,)) for thread_id in thread_ids]
+    feeder = threading.Thread(target=feed)
+    for worker in chats + [feeder]:
+        worker.start()
+    time.sleep(args.duration)
+    stop.set()
+    for worker in chats + [feeder]:
+        worker.join()
+
+    return {
+        'chats': len(thread_ids),
+        'latency': summarize(durations),
+        'polls_per_second': round(len(durations) / args.duration, 1),
+        'statuses': statuses,
+        'messages_received': sum(received.values()),
+        'upstream_calls': sum(fake.calls.values()),
+    }
+
+
+def wait_until(predicate, timeout):
+    """Poll predicate until it holds; returns the seconds waited, or None on timeout."""
+    began = time.perf_counter()
+    while time.perf_counter() - began < timeout:
+        if predicate():
+            return time.perf_counter() - began
+        time.sleep(0.01)
+    return None
+
+
+def scenario_send(bench, args):
+    """Accept latency of /api/send and how long the outbox takes to deliver everything."""
+    username = 'bench-send'
+    thread_ids = list(bench.client(username).threads)
+    requests = [('POST', f"/api/send/{thread_ids[i % len(thread_ids)]}",
+                 {'message': f"bench {i}", 'idempotency_key': f"bench-{args.seed}-{i}"})
+                for i in range(args.sends)]
+    began = time.perf_counter()
+    durations, statuses, _ = bench.run_concurrently(username, requests, args.concurrency)
+
+    def delivered():
+        with bench.app.app.app_context():
+            return not bench.app.OutboundMessage.query.filter_by(account=username, status='pending').count()
+
+    waited = wait_until(delivered, args.timeout)
+    return {
+        'accept_latency': summarize(durations),
+        'statuses': statuses,
+        'delivered_seconds': round(time.perf_counter() - began, 3) if waited is not None else None,
+        'sends': args.sends,
+    }
+
+
+def scenario_broadcast(bench, args):
+    """Time for a broadcast to reach every target."""
+    username = 'bench-broadcast'
+    fake = bench.client(username)
+    # Targets beyond the synthetic inbox get empty threads so every send can land
+    thread_ids = [str(1000 + i) for i in range(args.broadcast_targets)]
+    for thread_id in thread_ids:
+        fake.threads.setdefault(thread_id, [])
+    http = bench.http(username)
+
+    began = time.perf_counter()
+    response = http.post('/api/broadcast', json={'message': 'bench notice', 'thread_ids': thread_ids})
+    if response.status_code != 202:
+        return {'error': response.get_json()}
+    status_url = response.get_json()['status_url']
+    waited = wait_until(lambda: http.get(status_url).get_json()['status'] == 'done', args.timeout)
+    status = http.get(status_url).get_json()
+    return {
+        'targets': len(thread_ids),
+        'done_seconds': round(time.perf_counter() - began, 3) if waited is not None else None,
+        'counts': status['counts'],
+        'send_calls': fake.calls['direct_send'],
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+def flatten(results, prefix=''):
+    """scenario.metric.path -> number, for comparing two runs."""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(previous, current):
+    """Print every metric of current next to previous with the relative change."""
+    old, new = flatten(previous['scenarios']), flatten(current['scenarios'])
+    print(f"\n{'metric':<45} {'before':>12} {'after':>12} {'change':>9}")
+    for name in sorted(set(old) & set(new)):
+        change = f"{(new[name] - old[name]) / old[name] * 100:+.1f}%" if old[name] else ''
+        print(f"{name:<45} {old[name]:>12} {new[name]:>12} {change:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    fake = parser.add_argument_group('fake Instagram')
+    fake.add_argument('--threads', type=int, default=20, help='threads per account')
+    fake.add_argument('--messages', type=int, default=200, help='messages per thread')
+    fake.add_argument('--participants', type=int, default=2, help='other users per thread')
+    fake.add_argument('--media-mix', type=float, default=0.2, help='share of messages that carry media')
+    fake.add_argument('--latency', type=float, default=0.0, help='seconds added to every upstream call')
+    fake.add_argument('--error-rate', type=float, default=0.0, help='share of upstream calls that fail')
+    fake.add_argument('--seed', type=int, default=0)
+    load = parser.add_argument_group('load')
+    load.add_argument('--iterations', type=int, default=200, help='requests per latency scenario')
+    load.add_argument('--concurrency', type=int, default=8, help='concurrent request threads')
+    load.add_argument('--chats', type=int, default=20, help='open chats in the polling scenario')
+    load.add_argument('--poll-interval', type=float, default=0.5, help='seconds between one chat\'s polls')
+    load.add_argument('--incoming-rate', type=float, default=5, help='incoming messages per second while polling')
+    load.add_argument('--duration', type=float, default=10, help='seconds the polling scenario runs')
+    load.add_argument('--sends', type=int, default=100, help='messages sent in the send scenario')
+    load.add_argument('--broadcast-targets', type=int, default=100)
+    load.add_argument('--requests-per-minute', type=int, default=100000, help='per-account upstream budget')
+    load.add_argument('--timeout', type=float, default=120, help='longest wait for background delivery')
+    parser.add_argument('--output', help='results file (default: bench_results/<revision>-<time>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(sorted(unknown))}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+
+    with tempfile.TemporaryDirectory(prefix='instagram-dm-bench-') as workdir:
+        bench = Bench(load_app(workdir, args), args)
+        results = {
+            'meta': {
+                'revision': git_revision(),
+                'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+            },
+            'params': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+            'scenarios': {},
+        }
+        for name in args.scenarios:
+            print(f"Running {name}...", file=sys.stderr)
+            results['scenarios'][name] = globals()[f"scenario_{name}"](bench, args)
+            print(json.dumps(results['scenarios'][name], indent=2), file=sys.stderr)
+
+    output = args.output or os.path.join(
+        'bench_results', f"{results['meta']['revision'] or 'unknown'}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBus:
+    """In-process bus: publish calls the channel's subscribers right away. Enough for a single process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handlers = {}  # channel -> [callback]
+        self.published = 0
+
+    def subscribe(self, channel, callback):
+        with self.lock:
+            self.handlers.setdefault(channel, []).append(callback)
+
+    def _dispatch(self, channel, payload):
+        with self.lock:
+            handlers = list(self.handlers.get(channel, ()))
+        for callback in handlers:
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.error(f"Error handling {channel} event: {e}")
+
+    def publish(self, channel, payload):
+        self.published += 1
+        self._dispatch(channel, payload)
+
+    def stats(self):
+        return {'backend': 'local', 'published': self.published}
+
+
+class SQLiteBus(LocalBus):
+    """Bus over a table in a SQLite file, for several processes on one host.
+
+    Every process that subscribes polls the table and sees every event
+    published after it opened the bus, its own included. Events are JSON
+    and are deleted after `retention` seconds.
+    """
+
+    def __init__(self, path, poll_interval=0.05, retention=60):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.local = threading.local()  # one connection per thread
+        self.listener = None
+        self.received = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("""CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, payload TEXT NOT NULL,
+            created_at REAL NOT NULL)""")
+        self.last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def subscribe(self, channel, callback):
+        super().subscribe(channel, callback)
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self._listen, name='event-bus', daemon=True)
+                self.listener.start()
+
+    def publish(self, channel, payload):
+        self._connection().execute("INSERT INTO events (channel, payload, created_at) VALUES (?, ?, ?)",
+                                   (channel, json.dumps(payload), time.time()))
+        self.published += 1
+
+    def _listen(self):
+        conn = self._connection()
+        pruned = time.monotonic()
+        while True:
+            rows = []
+            try:
+                rows = conn.execute("SELECT id, channel, payload FROM events WHERE id > ? ORDER BY id",
+                                    (self.last_id,)).fetchall()
+                for event_id, channel, payload in rows:
+                    self.last_id = event_id
+                    self.received += 1
+                    self._dispatch(channel, json.loads(payload))
+                if time.monotonic() - pruned > self.retention:
+                    conn.execute("DELETE FROM events WHERE created_at < ?", (time.time() - self.retention,))
+                    pruned = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error reading events from {self.path}: {e}")
+            if not rows:
+                time.sleep(self.poll_interval)
+
+    def stats(self):
+        return {'backend': 'sqlite', 'path': self.path, 'published': self.published, 'received': self.received,
+                'last_id': self.last_id}
+
+
+def open_bus(url=None):
+    """Bus for a URL: empty or "local" for the in-process bus, "sqlite:///path" for a shared file."""
+    if not url or url == 'local':
+        return LocalBus()
+    if url.startswith('sqlite:///'):
+        return SQLiteBus(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported EVENT_BUS {url!r}")
@@ -0,0 +1,95 @@
+import threading
+import time
+
+
+class _Call:
+    """One in-flight load that other callers of the same key wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlightCache:
+    """Short-lived cache that lets concurrent callers of one key share a single load.
+
+    Keys are tuples. Loaders returning None are treated as failures and not cached.
+    """
+
+    def __init__(self, ttl, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {}  # key -> (expires_at, value)
+        self.in_flight = {}  # key -> _Call
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, loader):
+        """Return the cached value for key, or load it once for all concurrent callers."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            call = self.in_flight.get(key)
+            if call:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.misses += 1
+                call = _Call()
+                self.in_flight[key] = call
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = loader()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+                if call.error is None and call.value is not None and self.ttl > 0:
+                    self._store(key, call.value)
+            call.done.set()
+        return call.value
+
+    def put(self, key, value):
+        """Store a value loaded outside get(), e.g. one that arrived after its caller gave up."""
+        if value is not None and self.ttl > 0:
+            with self.lock:
+                self._store(key, value)
+
+    def _store(self, key, value):
+        now = time.monotonic()
+        if len(self.entries) >= self.max_entries:
+            self.entries = {k: v for k, v in self.entries.items() if v[0] > now}
+        self.entries[key] = (now + self.ttl, value)
+
+    def invalidate(self, *prefix):
+        """Drop every cached key starting with the given elements."""
+        n = len(prefix)
+        with self.lock:
+            for key in [k for k in self.entries if k[:n] == prefix]:
+                del self.entries[key]
+
+    def stats(self):
+        """Hit/miss counters for monitoring."""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'entries': len(self.entries),
+                'in_flight': len(self.in_flight),
+                'ttl': self.ttl,
+            }
@@ -0,0 +1,112 @@
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+
+class ClientPool:
+    """Bounded registry of instagrapi clients with LRU and idle eviction.
+
+    factory(username) builds a client (restoring a saved session if there is
+    one) and on_evict(username, client) is called for every client dropped
+    for size or idleness so its settings can be saved first.
+    """
+
+    def __init__(self, factory, on_evict, max_size=50, idle_timeout=1800):
+        self.factory = factory
+        self.on_evict = on_evict
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.clients = OrderedDict()  # username -> client, least recently used first
+        self.last_used = {}  # username -> monotonic time
+        self.evictions = 0
+
+    def get(self, username):
+        """Return the client for username, creating or restoring it if needed."""
+        built = None
+        while True:
+            with self.lock:
+                cl = self.clients.get(username)
+                if cl is None and built is not None:
+                    cl = self.clients[username] = built
+                if cl is not None:
+                    self.clients.move_to_end(username)
+                    self.last_used[username] = time.monotonic()
+                    evicted = self._collect_evictions()
+                    break
+            # Building may restore a session from disk, so it runs outside the lock; if another
+            # request stored a client for username meanwhile, that one is used and this one dropped
+            built = self.factory(username)
+        self._evict(evicted)
+        return cl
+
+    def pop(self, username):
+        """Remove a client without saving it (e.g. on logout)."""
+        with self.lock:
+            self.last_used.pop(username, None)
+            return self.clients.pop(username, None)
+
+    def evict_idle(self):
+        """Drop clients unused for longer than the idle timeout."""
+        with self.lock:
+            evicted = self._collect_evictions()
+        self._evict(evicted)
+        return len(evicted)
+
+    def _collect_evictions(self):
+        # Called with the lock held; returns (username, client) pairs removed
+        evicted = []
+        now = time.monotonic()
+        for username in list(self.clients):
+            if len(self.clients) > self.max_size or now - self.last_used[username] > self.idle_timeout:
+                evicted.append((username, self.clients.pop(username)))
+                del self.last_used[username]
+        self.evictions += len(evicted)
+        return evicted
+
+    def _evict(self, evicted):
+        for username, cl in evicted:
+            self.on_evict(username, cl)
+
+    def __contains__(self, username):
+        with self.lock:
+            return username in self.clients
+
+    def __len__(self):
+        with self.lock:
+            return len(self.clients)
+
+    def stats(self):
+        """Live-client count and a rough memory estimate for capacity planning."""
+        with self.lock:
+            clients = list(self.clients.values())
+            evictions = self.evictions
+        memory = sum(approx_size(cl) for cl in clients)
+        return {
+            'live_clients': len(clients),
+            'max_size': self.max_size,
+            'idle_timeout': self.idle_timeout,
+            'evictions': evictions,
+            'approx_memory_bytes': memory,
+        }
+
+
+def approx_size(obj, depth=8, seen=None):
+    """Rough deep size of obj in bytes, following containers and attributes a few levels down."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj, 0)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        items = list(obj.keys()) + list(obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        items = list(obj)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+        items = list(vars(obj).values())
+    else:
+        items = []
+    return size + sum(approx_size(item, depth - 1, seen) for item in items)
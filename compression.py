@@ -0,0 +1,25 @@
+import gzip
+
+# Brotli is optional; without it responses fall back to gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Preferred first
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+
+def negotiate(accept_encodings):
+    """Best encoding we can produce that the client accepts (a werkzeug Accept), or None."""
+    for encoding in ENCODINGS:
+        if accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+def compress(data, encoding):
+    """Compress bytes with a level that suits per-request work rather than archives."""
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
@@ -0,0 +1,178 @@
+import copy
+import itertools
+import random
+import threading
+import time
+import types
+
+# Synthetic items are one minute apart starting at 2024-01-01 00:00 UTC
+BASE_TIMESTAMP = 1704067200
+ITEM_ID_BASE = 10 ** 36
+
+# Media kinds a synthetic item can be, besides plain text
+MEDIA_KINDS = ('photo', 'video', 'voice', 'media_share', 'clip')
+
+
+class FakeClientError(Exception):
+    """Injected upstream failure."""
+
+
+class FakeClient:
+    """Deterministic in-process stand-in for instagrapi.Client.
+
+    Serves synthetic threads through the same methods app.py calls
+    (direct_threads, direct_thread, private_request paging, direct_send),
+    returning real instagrapi models, with optional latency and errors.
+    The same arguments and seed always produce the same inbox.
+    """
+
+    def __init__(self, username='bench', threads=20, messages=200, participants=2, media_mix=0.2,
+                 latency=0.0, error_rate=0.0, seed=0):
+        self.username = username
+        self.user_id = 1
+        self.password = None
+        self.latency = latency
+        self.error_rate = error_rate
+        self.participants = max(1, participants)
+        self.media_mix = media_mix
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(ITEM_ID_BASE)
+        self.clock = itertools.count()
+        self.calls = {'direct_threads': 0, 'direct_thread': 0, 'private_request': 0, 'direct_send': 0}
+        self.errors = 0
+        self.threads = {}  # thread id -> raw items, newest first
+        for t in range(threads):
+            thread_id = str(1000 + t)
+            items = [self._item(self._sender(i), f"message {i} in thread {thread_id}") for i in range(messages)]
+            items.reverse()
+            self.threads[thread_id] = items
+
+    # Session handling is a no-op: every fake client is logged in
+    def login(self, username, password):
+        self.password = password
+        return True
+
+    def logout(self):
+        return True
+
+    def get_settings(self):
+        return {'authorization_data': {'ds_user_id': str(self.user_id)}, 'cookies': {}, 'fake': True}
+
+    def set_settings(self, settings):
+        return True
+
+    def _sender(self, i):
+        # Alternate between us (pk 1) and the other participants (pk 2..)
+        return 1 if i % 2 == 0 else 2 + (i // 2) % self.participants
+
+    def _item(self, user_id, text, media=True):
+        item_id = str(next(self.ids))
+        item = {
+            'item_id': item_id,
+            'user_id': user_id,
+            'timestamp': (BASE_TIMESTAMP + next(self.clock) * 60) * 1_000_000,
+            'item_type': 'text',
+            'text': text,
+        }
+        if media and self.random.random() < self.media_mix:
+            kind = self.random.choice(MEDIA_KINDS)
+            url = f"https://cdn.fake.invalid/{kind}/{item_id}"
+            item['text'] = None
+            if kind in ('photo', 'video'):
+                payload = {'id': item_id, 'media_type': 1 if kind == 'photo' else 2}
+                if kind == 'photo':
+                    payload['image_versions2'] = {'candidates': [{'url': url, 'width': 1080, 'height': 1350}]}
+                else:
+                    # Like Instagram's, a video also carries its cover frame as an image
+                    payload['image_versions2'] = {'candidates': [{'url': f"{url}/cover", 'width': 720, 'height': 1280}]}
+                    payload['video_versions'] = [{'url': url, 'width': 720, 'height': 1280}]
+                item.update(item_type='media', media=payload)
+            elif kind == 'voice':
+                item.update(item_type='voice_media', voice_media={
+                    'media': {'id': item_id, 'media_type': 11, 'audio': {'audio_src': url}}})
+            elif kind == 'media_share':
+                item.update(item_type='media_share', media_share={
+                    'id': f"{item_id}_1", 'pk': item_id, 'code': 'Bfake', 'taken_at': BASE_TIMESTAMP,
+                    'media_type': 1, 'user': {'pk': '2', 'username': 'user2'},
+                    'image_versions2': {'candidates': [{'url': url, 'width': 640, 'height': 640}]}})
+            else:
+                item.update(item_type='clip', clip={'clip': {
+                    'id': f"{item_id}_1", 'pk': item_id, 'code': 'Cfake', 'taken_at': BASE_TIMESTAMP,
+                    'media_type': 2, 'product_type': 'clips', 'user': {'pk': '2', 'username': 'user2'},
+                    'video_versions': [{'url': url, 'width': 720, 'height': 1280}]}})
+        return item
+
+    def _raw_thread(self, thread_id, items, cursor):
+        users = [{'pk': str(pk), 'username': f"user{pk}", 'full_name': '', 'profile_pic_url': None}
+                 for pk in range(2, 2 + self.participants)]
+        return {
+            'thread_id': thread_id, 'thread_v2_id': thread_id, 'pk': thread_id, 'items': items, 'users': users,
+            'admin_user_ids': [], 'last_activity_at': items[0]['timestamp'] if items else 0,
+            'muted': False, 'named': False, 'canonical': True, 'pending': False, 'archived': False,
+            'thread_type': 'private', 'thread_title': ', '.join(u['username'] for u in users), 'folder': 0,
+            'vc_muted': False, 'is_group': self.participants > 1, 'mentions_muted': False,
+            'approval_required_for_new_members': False, 'input_mode': 0, 'business_thread_folder': 0,
+            'read_state': 0, 'is_close_friend_thread': False, 'assigned_admin_id': 0, 'shh_mode_enabled': False,
+            'last_seen_at': {}, 'oldest_cursor': cursor, 'has_older': cursor is not None,
+        }
+
+    def _call(self, name):
+        """Count a call, wait out the injected latency and maybe fail."""
+        with self.lock:
+            self.calls[name] += 1
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise FakeClientError(f"Injected failure in {name}")
+
+    def _page(self, thread_id, cursor, limit):
+        # Like Instagram's, a cursor is the id of the oldest item already seen, so it stays
+        # valid while new items arrive at the front
+        with self.lock:
+            items = self.threads[str(thread_id)]
+            start = 0
+            if cursor:
+                start = next((i for i, item in enumerate(items) if int(item['item_id']) < int(cursor)), len(items))
+            chunk = copy.deepcopy(items[start:start + limit])
+            more = start + limit < len(items)
+        return self._raw_thread(str(thread_id), chunk, chunk[-1]['item_id'] if more and chunk else None)
+
+    def direct_threads(self, amount=20, thread_message_limit=None, **kwargs):
+        from instagrapi.extractors import extract_direct_thread
+        self._call('direct_threads')
+        with self.lock:
+            recent = sorted(self.threads, key=lambda t: -int(self.threads[t][0]['item_id']) if self.threads[t] else 0)
+        # The inbox carries each thread's newest items, 10 unless asked otherwise, as Instagram's does
+        return [extract_direct_thread(self._page(thread_id, None, thread_message_limit or 10))
+                for thread_id in recent[:amount]]
+
+    def direct_thread(self, thread_id, amount=20):
+        from instagrapi.extractors import extract_direct_thread
+        self._call('direct_thread')
+        return extract_direct_thread(self._page(thread_id, None, amount))
+
+    def private_request(self, endpoint, params=None, data=None, **kwargs):
+        # Only the thread pages of fetch_thread_page come through here
+        self._call('private_request')
+        thread_id = endpoint.strip('/').split('/')[2]
+        params = params or {}
+        return {'thread': self._page(thread_id, params.get('cursor'), int(params.get('limit', 20)))}
+
+    def direct_send(self, text, user_ids=(), thread_ids=(), **kwargs):
+        self._call('direct_send')
+        with self.lock:
+            sent = [self._item(self.user_id, text, media=False) for _ in thread_ids or [None]]
+            for thread_id, item in zip(thread_ids, sent):
+                self.threads.setdefault(str(thread_id), []).insert(0, item)
+        return types.SimpleNamespace(id=sent[0]['item_id'], text=text)
+
+    def receive(self, thread_id, text):
+        """Simulate someone else posting to a thread."""
+        with self.lock:
+            item = self._item(2, text, media=False)
+            self.threads[str(thread_id)].insert(0, item)
+        return item['item_id']
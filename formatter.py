@@ -0,0 +1,215 @@
+from datetime import datetime
+
+# item_type -> function(msg, content) filling in the display fields
+EXTRACTORS = {}
+
+
+def extractor(*item_types):
+    """Register a function as the content extractor for the given item types."""
+    def register(func):
+        for item_type in item_types:
+            EXTRACTORS[item_type] = func
+        return func
+    return register
+
+
+def _get(obj, *path):
+    """Follow attributes or dict keys along path, returning None if any step is missing."""
+    for name in path:
+        if obj is None:
+            return None
+        if isinstance(obj, dict):
+            obj = obj.get(name)
+        else:
+            obj = getattr(obj, name, None)
+    return obj
+
+
+def _first(items):
+    return items[0] if items else None
+
+
+@extractor('text')
+def extract_text(msg, content):
+    content['text'] = msg.text or ""
+
+
+@extractor('media_share')
+def extract_media_share(msg, content):
+    thumbnail_url = _get(msg, 'media_share', 'thumbnail_url')
+    if thumbnail_url:
+        content['media_url'] = thumbnail_url
+        content['text'] = "[Shared Post]"
+
+
+@extractor('media')
+def extract_media(msg, content):
+    # For images and videos sent directly; videos also carry their cover in image_versions2
+    media = _get(msg, 'visual_media', 'media')
+    image = _first(_get(media, 'image_versions2', 'candidates'))
+    video = _first(_get(media, 'video_versions'))
+    if video:
+        content['media_url'] = _get(video, 'url')
+        content['text'] = "[Video]"
+        content['video'] = True
+    elif image:
+        content['media_url'] = _get(image, 'url')
+        content['text'] = "[Photo]"
+    elif _get(msg, 'media', 'video_url'):
+        content['media_url'] = msg.media.video_url
+        content['text'] = "[Video]"
+        content['video'] = True
+    elif _get(msg, 'media', 'thumbnail_url'):
+        content['media_url'] = msg.media.thumbnail_url
+        content['text'] = "[Photo]"
+
+
+@extractor('voice_media')
+def extract_voice(msg, content):
+    content['type'] = 'voice'
+    content['text'] = "[Voice Message]"
+    content['media_url'] = (_get(msg, 'voice_media', 'media', 'audio', 'audio_src')
+                            or _get(msg, 'media', 'audio_url'))
+
+
+@extractor('story_share')
+def extract_story(msg, content):
+    content['type'] = 'story'
+    content['text'] = "[Shared Story]"
+
+
+@extractor('reel_share')
+def extract_reel(msg, content):
+    content['type'] = 'reel'
+    content['text'] = "[Shared Reel]"
+
+
+@extractor('clip')
+def extract_clip(msg, content):
+    content['text'] = "[Clip]"
+    video = _first(_get(msg, 'clip', 'media', 'video_versions')) or _get(msg, 'clip', 'video_url')
+    if video:
+        # A video_versions entry, or the Media model's video_url (a pydantic URL, not a str)
+        content['media_url'] = _get(video, 'url') if isinstance(video, dict) else str(video)
+        content['video'] = True
+
+
+def extract_other(msg, content):
+    content['type'] = 'other'
+    content['text'] = f"[{msg.item_type}]"
+
+
+def extract_content(msg):
+    """Reduce a DirectMessage to the type, text and media the chat view shows."""
+    item_type = getattr(msg, 'item_type', None)
+    if item_type is None:
+        # If no item_type, default to text
+        return {'type': 'text', 'text': msg.text or "[Media or other content]", 'media_url': None, 'video': False}
+
+    content = {'type': item_type, 'text': None, 'media_url': None, 'video': False}
+    EXTRACTORS.get(item_type, extract_other)(msg, content)
+    if content['media_url'] is not None:
+        content['media_url'] = str(content['media_url'])
+    return content
+
+
+def build_sender_map(users, current_user_id):
+    """Map user pk -> display name once per thread; users are UserShort or Participant rows."""
+    sender_map = {}
+    for user in users:
+        pk = str(getattr(user, 'user_pk', None) or user.pk)
+        sender_map[pk] = user.username
+    sender_map[str(current_user_id)] = "You"
+    return sender_map
+
+
+def format_timestamp(timestamp, local_timezone):
+    """Format the timestamp to show how long ago the message was sent."""
+    # Convert the timestamp to the local timezone
+    local_timestamp = timestamp.astimezone(local_timezone)
+    now = datetime.now(local_timezone)  # Current time in the local timezone
+    delta = now - local_timestamp
+    if delta.days > 0:
+        return f"{delta.days} day(s) ago"
+    elif delta.seconds >= 3600:
+        hours = delta.seconds // 3600
+        return f"{hours} hour(s) ago"
+    elif delta.seconds >= 60:
+        minutes = delta.seconds // 60
+        return f"{minutes} minute(s) ago"
+    else:
+        return f"{delta.seconds} second(s) ago"
+
+
+def epoch_seconds(timestamp):
+    """Unix time of a stored timestamp; naive values are server local time, as instagrapi builds them."""
+    return int(timestamp.timestamp())
+
+
+def format_messages(messages, sender_map, current_user_id, media_url=None, thumbnail_width=None):
+    """Turn stored messages into the JSON the chat view renders.
+
+    Timestamps are epoch seconds, which the browser shows relative to now, so
+    the same messages always serialize the same way.
+    media_url(message_id, width=None), if given, maps each message to the URL its
+    media is served from; photos also get a thumbnail_url at thumbnail_width.
+    """
+    current_user_id = str(current_user_id)
+    formatted_messages = []
+    for msg in messages:
+        message_data = {
+            'id': msg.message_id,
+            'sender': sender_map.get(msg.user_id, "User"),
+            'timestamp': epoch_seconds(msg.timestamp) if msg.timestamp else None,
+            'is_current_user': msg.user_id == current_user_id,
+            'type': msg.message_type,
+            'text': msg.text,
+        }
+        if msg.media_url:
+            message_data['media_url'] = media_url(msg.message_id) if media_url else msg.media_url
+            if media_url and thumbnail_width and not msg.is_video and msg.message_type != 'voice':
+                message_data['thumbnail_url'] = media_url(msg.message_id, thumbnail_width)
+        if msg.is_video:
+            message_data['video'] = True
+        formatted_messages.append(message_data)
+    return formatted_messages
+
+
+def format_threads(threads, current_user_id, media_url=None, thumbnail_width=None):
+    """Batch form of format_messages over many threads (e.g. from a background sync).
+
+    threads maps thread id -> (messages, users); each thread's sender map is built
+    once. Returns thread id -> formatted messages.
+    """
+    return {
+        thread_id: format_messages(messages, build_sender_map(users, current_user_id), current_user_id,
+                                   media_url, thumbnail_width)
+        for thread_id, (messages, users) in threads.items()
+    }
+
+
+# Column order of a message row in the compact encoding
+COMPACT_FIELDS = ('id', 'sender', 'timestamp', 'type', 'text', 'media_url', 'thumbnail_url', 'video')
+
+
+def compact_messages(messages, formatted, users, current_user_id):
+    """Re-encode format_messages output with each participant listed once.
+
+    Returns (users, me, rows): users is a list of {pk, username} that includes
+    the current user at index me, and each row holds COMPACT_FIELDS with the
+    sender given as an index into users (None if unknown).
+    """
+    current_user_id = str(current_user_id)
+    listed = [{'pk': str(getattr(user, 'user_pk', None) or user.pk), 'username': user.username} for user in users]
+    index = {user['pk']: i for i, user in enumerate(listed)}
+    if current_user_id not in index:
+        index[current_user_id] = len(listed)
+        listed.append({'pk': current_user_id, 'username': "You"})
+
+    rows = []
+    for msg, message_data in zip(messages, formatted):
+        row = [message_data.get(field) for field in COMPACT_FIELDS]
+        row[1] = index.get(msg.user_id)
+        rows.append(row)
+    return listed, index[current_user_id], rows
+
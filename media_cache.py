@@ -0,0 +1,158 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+
+class MediaCache:
+    """Content-addressed disk cache for proxied media, bounded in bytes with LRU eviction.
+
+    Blobs live under blobs/<digest[:2]>/<digest>, named by the sha256 of
+    their content, so the same photo shared into many threads is stored once.
+    A ref file per key records which blob it points to and its content type.
+    Reading a blob bumps its mtime, which is what eviction orders by. Eviction
+    goes down to low_water of max_bytes, so a full cache rescans the disk
+    once per that much new media rather than on every store.
+    """
+
+    def __init__(self, directory, max_bytes=1024 ** 3, low_water=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water_bytes = int(max_bytes * low_water)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'refs'), exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._blobs())
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest[:2], digest)
+
+    def _ref_path(self, key):
+        return os.path.join(self.directory, 'refs', hashlib.sha256(key.encode()).hexdigest())
+
+    def lookup(self, key):
+        """Return (path, digest, content_type) for a cached key, or None."""
+        try:
+            with open(self._ref_path(key)) as f:
+                digest, content_type = f.read().split('\n', 1)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        path = self.blob_path(digest)
+        try:
+            os.utime(path)
+        except OSError:
+            # The blob was evicted; the ref is stale
+            self.forget(key)
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return path, digest, content_type
+
+    def store(self, key, chunks, content_type):
+        """Write an iterable of byte chunks to the cache under key and return lookup()'s tuple."""
+        hasher = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.media.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            digest = hasher.hexdigest()
+            path = self.blob_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self.lock:
+                if os.path.exists(path):
+                    os.remove(tmp_path)
+                    os.utime(path)
+                else:
+                    os.replace(tmp_path, path)
+                    self.total_bytes += size
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        ref_path = self._ref_path(key)
+        fd, tmp_ref = tempfile.mkstemp(dir=os.path.dirname(ref_path), prefix='.ref.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(f"{digest}\n{content_type}")
+        os.replace(tmp_ref, ref_path)
+
+        if self.total_bytes > self.max_bytes:
+            self.evict(keep=digest)
+        return path, digest, content_type
+
+    def forget(self, key):
+        """Drop key's ref, e.g. when its blob turned out to be gone; the next lookup is a miss."""
+        try:
+            os.remove(self._ref_path(key))
+        except OSError:
+            pass
+
+    def _blobs(self):
+        """Yield (mtime, path, size) for every blob on disk."""
+        root = os.path.join(self.directory, 'blobs')
+        for prefix in os.listdir(root):
+            subdir = os.path.join(root, prefix)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                path = os.path.join(subdir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, path, st.st_size
+
+    def evict(self, keep=None):
+        """Delete least recently used blobs until the cache is back under its low-water mark, and their refs."""
+        evicted = set()
+        with self.lock:
+            blobs = sorted(self._blobs())
+            self.total_bytes = sum(size for _, _, size in blobs)
+            for _, path, size in blobs:
+                if self.total_bytes <= self.low_water_bytes:
+                    break
+                if keep and os.path.basename(path) == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                evicted.add(os.path.basename(path))
+                self.total_bytes -= size
+                self.evictions += 1
+        if evicted:
+            self._remove_refs(evicted)
+
+    def _remove_refs(self, digests):
+        """Delete the ref files pointing at any of digests."""
+        root = os.path.join(self.directory, 'refs')
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            try:
+                with open(path) as f:
+                    digest = f.readline().strip()
+                if digest in digests:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+            }
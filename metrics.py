@@ -0,0 +1,137 @@
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+# Seconds; covers fast cache-backed routes up to upstream calls near their timeout
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Collects metrics and renders them in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter:
+    """Monotonic count, optionally split by labels."""
+    type = 'counter'
+
+    def __init__(self, registry, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> count
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in sorted(values.items())]
+
+
+class Histogram:
+    """Distribution of observed values (latencies, in seconds) in cumulative buckets."""
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.lock = threading.Lock()
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes, whether or not it raises."""
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - began, **labels)
+
+    def samples(self):
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        lines = []
+        for key, values in sorted(series.items()):
+            for bound, count in zip(self.buckets, values):
+                le = _format_labels(self.labels, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(values[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {values[-1]}")
+        return lines
+
+
+class Collected:
+    """Metric read from existing state when scraped, e.g. a pool size or a stats counter.
+
+    func returns a number, or a dict of label value tuples -> number when labels are given.
+    """
+
+    def __init__(self, registry, name, help, func, type='gauge', labels=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+        self.labels = tuple(labels)
+        registry.register(self)
+
+    def samples(self):
+        value = self.func()
+        if not self.labels:
+            return [f"{self.name} {_format_value(value)}"]
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(v)}"
+                for key, v in sorted(value.items())]
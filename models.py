@@ -0,0 +1,200 @@
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sqlite3
+
+db = SQLAlchemy()
+
+# Instagram item ids are ~38 digit integers; pad them so string order is numeric order
+MESSAGE_ID_WIDTH = 40
+
+
+def message_sort_key(message_id):
+    """Return a key that sorts message ids in numeric order."""
+    return str(message_id).zfill(MESSAGE_ID_WIDTH)
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Let the pollers write while request handlers read."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+
+class Thread(db.Model):
+    """A direct thread as last seen by one account."""
+    __tablename__ = 'threads'
+    __table_args__ = (
+        db.UniqueConstraint('account', 'thread_id', name='uq_thread_account_thread'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(64), nullable=False)
+    thread_id = db.Column(db.String(64), nullable=False, index=True)
+    title = db.Column(db.String(255))
+    is_group = db.Column(db.Boolean, default=False)
+    last_activity_at = db.Column(db.DateTime)
+    newest_message_id = db.Column(db.String(64))
+    synced_at = db.Column(db.DateTime)
+
+
+class Participant(db.Model):
+    """A user taking part in a stored thread."""
+    __tablename__ = 'participants'
+    __table_args__ = (
+        db.UniqueConstraint('account', 'thread_id', 'user_pk', name='uq_participant'),
+        db.Index('ix_participants_thread', 'account', 'thread_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(64), nullable=False)
+    thread_id = db.Column(db.String(64), nullable=False)
+    user_pk = db.Column(db.String(64), nullable=False)
+    username = db.Column(db.String(255))
+
+
+class Message(db.Model):
+    """A stored direct message, already reduced to what the chat view shows."""
+    __tablename__ = 'messages'
+    __table_args__ = (
+        db.UniqueConstraint('account', 'thread_id', 'message_id', name='uq_message'),
+        db.Index('ix_messages_thread_sort', 'account', 'thread_id', 'sort_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(64), nullable=False)
+    thread_id = db.Column(db.String(64), nullable=False)
+    message_id = db.Column(db.String(64), nullable=False, index=True)
+    sort_key = db.Column(db.String(MESSAGE_ID_WIDTH), nullable=False)
+    user_id = db.Column(db.String(64))
+    timestamp = db.Column(db.DateTime)
+    item_type = db.Column(db.String(32))
+    message_type = db.Column(db.String(32))  # as shown by the chat view
+    text = db.Column(db.Text)
+    media_url = db.Column(db.Text)
+    is_video = db.Column(db.Boolean, default=False)
+    payload = db.Column(db.JSON)  # raw DirectMessage, for reprocessing
+
+
+class ThreadHistory(db.Model):
+    """How far back a thread's stored history reaches upstream."""
+    __tablename__ = 'thread_history'
+    __table_args__ = (
+        db.UniqueConstraint('account', 'thread_id', name='uq_thread_history'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(64), nullable=False)
+    thread_id = db.Column(db.String(64), nullable=False)
+    oldest_cursor = db.Column(db.String(255))  # upstream cursor for the page before our oldest message
+    has_older = db.Column(db.Boolean, default=True)
+
+
+class ThreadGap(db.Model):
+    """Stretch of a thread's history a sync skipped, between the oldest message it stored and older stored ones.
+
+    Left when a sync stops before reaching stored history; history reads fill it page by page.
+    """
+    __tablename__ = 'thread_gaps'
+    __table_args__ = (
+        db.Index('ix_thread_gaps_thread', 'account', 'thread_id', 'boundary_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(64), nullable=False)
+    thread_id = db.Column(db.String(64), nullable=False)
+    cursor = db.Column(db.String(255), nullable=False)  # upstream cursor of the first missing page
+    boundary_key = db.Column(db.String(MESSAGE_ID_WIDTH), nullable=False)  # sort key of the newest message below it
+
+
+class ThreadSummary(db.Model):
+    """Precomputed row of the thread list, kept current from inbox polls."""
+    __tablename__ = 'thread_summaries'
+    __table_args__ = (
+        db.UniqueConstraint('account', 'thread_id', name='uq_thread_summary'),
+        db.Index('ix_thread_summaries_recent', 'account', 'last_message_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(64), nullable=False)
+    thread_id = db.Column(db.String(64), nullable=False)
+    title = db.Column(db.String(255))
+    participants = db.Column(db.Text)  # comma separated usernames
+    last_message_id = db.Column(db.String(64))
+    last_message_text = db.Column(db.Text)
+    last_message_type = db.Column(db.String(32))
+    last_message_at = db.Column(db.DateTime)
+    unread_count = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime)
+
+
+class ThreadRead(db.Model):
+    """Newest message of a thread the account has seen in this app, which upstream read state may not know yet."""
+    __tablename__ = 'thread_reads'
+    __table_args__ = (
+        db.UniqueConstraint('account', 'thread_id', name='uq_thread_read'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(64), nullable=False)
+    thread_id = db.Column(db.String(64), nullable=False)
+    message_id = db.Column(db.String(64), nullable=False)
+
+
+class OutboundMessage(db.Model):
+    """A message accepted from the chat view, queued until it is delivered upstream."""
+    __tablename__ = 'outbound_messages'
+    __table_args__ = (
+        db.UniqueConstraint('account', 'idempotency_key', name='uq_outbound_key'),
+        db.Index('ix_outbound_due', 'account', 'status', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(64), nullable=False)
+    thread_id = db.Column(db.String(64), nullable=False)
+    idempotency_key = db.Column(db.String(64), nullable=False)  # chosen by the client per draft
+    text = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending, sent or failed
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    message_id = db.Column(db.String(64))  # upstream item id once sent
+    created_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+
+
+class Broadcast(db.Model):
+    """One text sent by an account to many threads or users as a background job."""
+    __tablename__ = 'broadcasts'
+    __table_args__ = (
+        db.Index('ix_broadcasts_account_status', 'account', 'status'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(64), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='running')  # running or done
+    created_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+
+class BroadcastTarget(db.Model):
+    """A thread or user a broadcast goes to, with its delivery outcome."""
+    __tablename__ = 'broadcast_targets'
+    __table_args__ = (
+        db.UniqueConstraint('broadcast_id', 'kind', 'target_id', name='uq_broadcast_target'),
+        db.Index('ix_broadcast_targets_status', 'broadcast_id', 'status'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    broadcast_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(8), nullable=False)  # thread or user
+    target_id = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending, sent or failed
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+    sent_at = db.Column(db.DateTime)
@@ -0,0 +1,78 @@
+import threading
+import time
+
+
+class Presence:
+    """Which accounts and threads someone is looking at, kept alive by heartbeats.
+
+    A view is one open page (a chat tab, the thread list) or a recent API
+    read, with the thread it shows if any. Each expires `ttl` seconds after
+    its last heartbeat unless it leaves first.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.views = {}  # username -> {view_id: (thread_id, expires_at)}
+
+    def _live(self, username):
+        # Called with the lock held; drops expired views and returns the rest
+        views = self.views.get(username)
+        if views is None:
+            return {}
+        now = time.monotonic()
+        for view_id in [v for v, (_, expires_at) in views.items() if expires_at <= now]:
+            del views[view_id]
+        if not views:
+            del self.views[username]
+        return views
+
+    def beat(self, username, view_id, thread_id=None):
+        """Record a heartbeat; returns True if it opened a view (new, expired, or moved to another thread)."""
+        with self.lock:
+            previous = self._live(username).get(view_id)
+            self.views.setdefault(username, {})[view_id] = (thread_id, time.monotonic() + self.ttl)
+            return previous is None or previous[0] != thread_id
+
+    def leave(self, username, view_id):
+        with self.lock:
+            self.views.get(username, {}).pop(view_id, None)
+            self._live(username)
+
+    def forget(self, username):
+        with self.lock:
+            self.views.pop(username, None)
+
+    def active(self, username):
+        with self.lock:
+            return bool(self._live(username))
+
+    def threads(self, username):
+        """Threads with at least one live view."""
+        with self.lock:
+            return {thread_id for thread_id, _ in self._live(username).values() if thread_id}
+
+    def expires_in(self, username):
+        """Seconds until the account's last live view expires without another heartbeat."""
+        with self.lock:
+            views = self._live(username)
+            if not views:
+                return 0
+            return max(expires_at for _, expires_at in views.values()) - time.monotonic()
+
+    def stats(self):
+        with self.lock:
+            accounts = {username: dict(self._live(username)) for username in list(self.views)}
+        viewers = {}
+        for username, views in accounts.items():
+            if not views:
+                continue
+            counts = viewers[username] = {}
+            for thread_id, _ in views.values():
+                counts[thread_id or 'inbox'] = counts.get(thread_id or 'inbox', 0) + 1
+        return {
+            'ttl': self.ttl,
+            'accounts': len(viewers),
+            'views': sum(sum(counts.values()) for counts in viewers.values()),
+            'viewers': viewers,
+        }
@@ -0,0 +1,231 @@
+from collections import Counter
+from contextlib import contextmanager
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+# Trace of the request being handled, also set in upstream workers while they run on its behalf
+_current = contextvars.ContextVar('trace', default=None)
+
+PROFILE_ID = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$')
+
+# Seconds between stack samples for the flame graph
+SAMPLE_INTERVAL = 0.005
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _fold(frame):
+    """Stack as root;...;leaf, the collapsed format flame graph tools read."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Trace:
+    """Timing spans, a cProfile of the request thread and stack samples of one request."""
+
+    def __init__(self, name):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.name = name
+        self.started_at = time.time()
+        self.began = time.perf_counter()
+        self.duration = None
+        self.lock = threading.Lock()
+        self.spans = []
+        self.threads = Counter()  # thread ident -> how many active() blocks it is inside
+        self.stacks = Counter()  # folded stack -> samples
+        self.profile = cProfile.Profile()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample, name=f"profile-{self.id}", daemon=True)
+        self.context = self.active()  # entered by Profiler.start for the request thread
+
+    def add_span(self, name, began, ended, **attrs):
+        with self.lock:
+            if self.duration is not None:
+                return  # finished while an upstream call was still running
+            self.spans.append({
+                'name': name,
+                'start_ms': round((began - self.began) * 1000, 3),
+                'duration_ms': round((ended - began) * 1000, 3),
+                'thread': threading.current_thread().name,
+                **attrs,
+            })
+
+    def _sample(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            with self.lock:
+                idents = [ident for ident, count in self.threads.items() if count]
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[_fold(frame)] += 1
+
+    @contextmanager
+    def active(self):
+        """Make this the current trace in the calling thread and include the thread in samples."""
+        token = _current.set(self)
+        ident = threading.get_ident()
+        with self.lock:
+            self.threads[ident] += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.threads[ident] -= 1
+            _current.reset(token)
+
+    def top_functions(self, limit=30):
+        """The request thread's most expensive functions by cumulative time, as pstats prints them."""
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def span(name, **attrs):
+    """Record the block as a span of the current trace; does nothing when the request is not profiled."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    began = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        attrs['error'] = type(e).__name__
+        raise
+    finally:
+        trace.add_span(name, began, time.perf_counter(), **attrs)
+
+
+class Profiler:
+    """Profiles chosen requests and keeps the newest results in a directory.
+
+    Each profile is <id>.json (spans and a summary), <id>.prof (cProfile of
+    the request thread, for pstats or snakeviz) and <id>.folded (stack samples
+    of the request and its upstream calls, for flamegraph.pl or speedscope).
+    """
+
+    def __init__(self, directory, sample_rate=0.0, keep=200):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.saved = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def sampled(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self, name):
+        """Begin profiling the calling thread; finish() must follow in the same thread."""
+        trace = Trace(name)
+        trace.context.__enter__()
+        trace.sampler.start()
+        try:
+            trace.profile.enable()
+        except ValueError:
+            trace.profile = None  # another profiler already owns this thread
+        return trace
+
+    def finish(self, trace, **summary):
+        """Stop profiling and write the trace's files; returns its summary."""
+        if trace.profile is not None:
+            trace.profile.disable()
+        trace.stopped.set()
+        trace.sampler.join()
+        trace.context.__exit__(None, None, None)
+        with trace.lock:
+            trace.duration = time.perf_counter() - trace.began
+            spans = sorted(trace.spans, key=lambda s: s['start_ms'])
+        summary = {
+            'id': trace.id,
+            'name': trace.name,
+            'started_at': trace.started_at,
+            'duration_ms': round(trace.duration * 1000, 3),
+            'spans': len(spans),
+            **summary,
+        }
+
+        base = os.path.join(self.directory, trace.id)
+        try:
+            with open(f"{base}.json", 'w') as f:
+                json.dump({**summary, 'spans': spans,
+                           'top_functions': trace.top_functions() if trace.profile else None}, f, indent=1)
+            if trace.profile is not None:
+                trace.profile.dump_stats(f"{base}.prof")
+            with open(f"{base}.folded", 'w') as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in trace.stacks.most_common())
+        except OSError:
+            return summary
+        with self.lock:
+            self.saved += 1
+        self.prune()
+        return summary
+
+    def _ids(self):
+        """Saved profile ids, oldest first."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(name[:-5] for name in names if name.endswith('.json') and PROFILE_ID.match(name[:-5]))
+
+    def prune(self):
+        for profile_id in self._ids()[:-self.keep or None]:
+            for extension in ('json', 'prof', 'folded'):
+                try:
+                    os.remove(os.path.join(self.directory, f"{profile_id}.{extension}"))
+                except OSError:
+                    pass
+
+    def path(self, profile_id, extension):
+        """File of a saved profile, or None if there is no such profile."""
+        if not PROFILE_ID.match(profile_id) or extension not in ('json', 'prof', 'folded'):
+            return None
+        path = os.path.join(self.directory, f"{profile_id}.{extension}")
+        return path if os.path.exists(path) else None
+
+    def load(self, profile_id):
+        path = self.path(profile_id, 'json')
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def summaries(self, limit=50):
+        """Newest saved profiles first, without their spans."""
+        summaries = []
+        for profile_id in reversed(self._ids()):
+            data = self.load(profile_id)
+            if data is not None:
+                data['spans'] = len(data['spans'])
+                data.pop('top_functions', None)
+                summaries.append(data)
+            if len(summaries) >= limit:
+                break
+        return summaries
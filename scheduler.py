@@ -0,0 +1,174 @@
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RateBudget:
+    """Token bucket limiting how many upstream requests one account may make."""
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst if burst is not None else max(1, per_minute // 4)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        """Whole requests that can be made right now."""
+        with self.lock:
+            self._refill()
+            return int(self.tokens)
+
+    def try_acquire(self, n=1):
+        """Take n tokens if there are enough; return whether they were taken."""
+        with self.lock:
+            self._refill()
+            if self.tokens >= n:
+                self.tokens -= n
+                return True
+            return False
+
+    def acquire(self, n=1, timeout=None):
+        """Take n tokens, waiting up to timeout seconds (forever if None); return whether they were taken."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.try_acquire(n):
+            wait = self.wait_time(n)
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+        return True
+
+    def wait_time(self, n=1):
+        """Seconds until n tokens will be available."""
+        with self.lock:
+            self._refill()
+            return max(0.0, (n - self.tokens) / self.rate) if self.rate else float('inf')
+
+
+class PollScheduler:
+    """Runs every poll job from one priority queue on a small worker pool.
+
+    A job has a hashable key, a budget (RateBudget) and a run() method that
+    does one poll and returns the delay in seconds until it should run again.
+    Each run is charged one request from the budget first; a job whose runs
+    often have nothing to do sets budget to None and charges its own.
+    """
+
+    def __init__(self, max_workers=4, jitter=0.1):
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.queue = []  # (due, seq, key)
+        self.jobs = {}  # key -> job
+        self.due = {}  # key -> due time of the job's live queue entry
+        self.running = set()
+        self.rerun = set()  # keys woken while running
+        self.seq = itertools.count()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='poll')
+        self.thread = None
+        self.stats = {'runs': 0, 'deferred': 0, 'errors': 0}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name='poll-scheduler', daemon=True)
+                self.thread.start()
+
+    def add(self, job, delay=None):
+        """Schedule a job; by default its first run is spread over a second to avoid bursts."""
+        if delay is None:
+            delay = random.uniform(0, 1)
+        with self.lock:
+            self.jobs[job.key] = job
+            self._schedule(job.key, delay)
+        self.start()
+
+    def remove(self, key):
+        with self.lock:
+            self.jobs.pop(key, None)
+            self.due.pop(key, None)
+            self.rerun.discard(key)
+
+    def wake(self, key):
+        """Run a job as soon as possible."""
+        with self.lock:
+            if key not in self.jobs:
+                return
+            if key in self.running:
+                self.rerun.add(key)
+            else:
+                self._schedule(key, 0)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.jobs)
+
+    def _schedule(self, key, delay):
+        # Called with the lock held
+        due = time.monotonic() + delay
+        self.due[key] = due
+        heapq.heappush(self.queue, (due, next(self.seq), key))
+        self.wakeup.notify()
+
+    def _loop(self):
+        while True:
+            with self.lock:
+                while True:
+                    # Skip entries replaced by a later (re)schedule or removal
+                    while self.queue and self.due.get(self.queue[0][2]) != self.queue[0][0]:
+                        heapq.heappop(self.queue)
+                    if self.queue and self.queue[0][0] <= time.monotonic():
+                        break
+                    timeout = self.queue[0][0] - time.monotonic() if self.queue else None
+                    self.wakeup.wait(timeout)
+                _, _, key = heapq.heappop(self.queue)
+                del self.due[key]
+                job = self.jobs[key]
+                if key in self.running:
+                    self.rerun.add(key)
+                    continue
+
+                # Hold the job back until its account can afford a request
+                if job.budget is not None and not job.budget.try_acquire():
+                    self.stats['deferred'] += 1
+                    self._schedule(key, job.budget.wait_time())
+                    continue
+                self.running.add(key)
+            self.executor.submit(self._run, key, job)
+
+    def _run(self, key, job):
+        try:
+            delay = job.run()
+        except Exception as e:
+            logger.error(f"Poll job {key} failed: {e}")
+            delay = None
+            self.stats['errors'] += 1
+        with self.lock:
+            self.stats['runs'] += 1
+            self.running.discard(key)
+            if self.jobs.get(key) is not job:
+                # Removed, or replaced by a new job that keeps its own schedule; one that came due while
+                # this run held the key was parked in rerun
+                if key in self.jobs and key in self.rerun:
+                    self.rerun.discard(key)
+                    self._schedule(key, 0)
+                return
+            if key in self.rerun:
+                self.rerun.discard(key)
+                delay = 0
+            elif delay is None:
+                delay = 60
+            else:
+                delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+            self._schedule(key, delay)
@@ -0,0 +1,124 @@
+from datetime import datetime
+from html import escape
+
+from sqlalchemy import text
+
+# FTS5 index over the text of text messages, kept in step with the messages table by triggers,
+# so everything the pollers store becomes searchable without extra writes in Python. Media
+# messages keep a display placeholder ("[Photo]") in messages.text, which must not match
+# searches, so the index reads a view that leaves their text NULL.
+SEARCH_TEXT = "CASE WHEN {row}.item_type = 'text' THEN {row}.text END"
+
+SEARCH_INDEX_DDL = (
+    f"""CREATE VIEW IF NOT EXISTS message_search_text AS
+        SELECT id, {SEARCH_TEXT.format(row='messages')} AS text FROM messages""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, content='message_search_text', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text) VALUES (new.id, {SEARCH_TEXT.format(row='new')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, {SEARCH_TEXT.format(row='old')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text, item_type ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, {SEARCH_TEXT.format(row='old')});
+        INSERT INTO messages_fts(rowid, text) VALUES (new.id, {SEARCH_TEXT.format(row='new')});
+    END""",
+)
+
+# An index built before it skipped media placeholders is dropped and rebuilt
+OUTDATED_INDEX_DDL = (
+    "DROP TRIGGER IF EXISTS messages_fts_insert",
+    "DROP TRIGGER IF EXISTS messages_fts_delete",
+    "DROP TRIGGER IF EXISTS messages_fts_update",
+    "DROP TABLE IF EXISTS messages_fts",
+)
+
+# How SQLAlchemy stores DateTime in SQLite, so range filters compare like for like
+SQLITE_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Snippet highlight markers, swapped for <mark> once the text is escaped
+_MARK_START, _MARK_END = '\x02', '\x03'
+
+
+def ensure_search_index(engine):
+    """Create the FTS5 index and its triggers, indexing existing messages the first time (or after an upgrade).
+
+    Returns False if the database is not SQLite, where search is unavailable.
+    """
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.begin() as conn:
+        sql = conn.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")).scalar()
+        exists = sql is not None and 'message_search_text' in sql
+        if sql is not None and not exists:
+            for statement in OUTDATED_INDEX_DDL:
+                conn.execute(text(statement))
+        for statement in SEARCH_INDEX_DDL:
+            conn.execute(text(statement))
+        if not exists:
+            conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+    return True
+
+
+def match_expression(query):
+    """Turn free text into an FTS5 query: every word must appear, the last one as a prefix.
+
+    Words are quoted so FTS5 operators and punctuation in user input are taken literally.
+    """
+    words = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+    if not words:
+        return None
+    words[-1] += '*'
+    return ' '.join(words)
+
+
+def search_messages(session, account, query, thread_id=None, user_ids=None, start=None, end=None,
+                    limit=20, offset=0):
+    """Ranked matches for query among one account's stored messages.
+
+    Returns dicts with thread_id, message_id, user_id, timestamp, snippet (HTML
+    with <mark> around matches) and rank, best match first.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return []
+
+    filters = ["messages_fts MATCH :expression", "m.account = :account"]
+    params = {'expression': expression, 'account': account, 'limit': limit, 'offset': offset}
+    if thread_id:
+        filters.append("m.thread_id = :thread_id")
+        params['thread_id'] = str(thread_id)
+    if user_ids is not None:
+        names = [f":user_{i}" for i in range(len(user_ids))] or ["NULL"]
+        filters.append(f"m.user_id IN ({', '.join(names)})")
+        params.update({f"user_{i}": str(user_id) for i, user_id in enumerate(user_ids)})
+    if start:
+        filters.append("m.timestamp >= :start")
+        params['start'] = start.strftime(SQLITE_DATETIME_FORMAT)
+    if end:
+        filters.append("m.timestamp < :end")
+        params['end'] = end.strftime(SQLITE_DATETIME_FORMAT)
+
+    rows = session.execute(text(f"""
+        SELECT m.thread_id, m.message_id, m.user_id, m.timestamp,
+               snippet(messages_fts, 0, '{_MARK_START}', '{_MARK_END}', '…', 12) AS snippet,
+               messages_fts.rank AS rank
+        FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+        WHERE {' AND '.join(filters)}
+        ORDER BY messages_fts.rank, m.sort_key DESC
+        LIMIT :limit OFFSET :offset
+    """), params)
+
+    return [
+        {
+            'thread_id': row.thread_id,
+            'message_id': row.message_id,
+            'user_id': row.user_id,
+            'timestamp': datetime.fromisoformat(row.timestamp) if row.timestamp else None,
+            'snippet': escape(row.snippet or '').replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>'),
+            'rank': row.rank,
+        }
+        for row in rows
+    ]
@@ -0,0 +1,70 @@
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class SessionVault:
+    """Keeps each account's instagrapi settings on disk, with when they were last verified.
+
+    Files keep the session_<username>.json name and settings layout that
+    Client.load_settings understands; the vault adds a "vault" key holding
+    last_verified and a salted password hash.
+    """
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, username):
+        return os.path.join(self.directory, f"session_{username}.json")
+
+    def load(self, username):
+        """Return the stored settings for username, or None."""
+        try:
+            with open(self.path(username)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def check_password(self, settings, password):
+        """True if password matches the hash saved with these settings."""
+        meta = settings.get('vault', {})
+        if 'salt' not in meta or 'password_hash' not in meta:
+            return False
+        return hmac.compare_digest(meta['password_hash'], _hash_password(password, meta['salt']))
+
+    def save(self, username, settings, password=None, verified=True):
+        """Atomically replace the stored settings.
+
+        Without a password the previously saved hash is kept; verified marks the
+        session as known to work now.
+        """
+        previous = (self.load(username) or {}).get('vault', {})
+        data = dict(settings)
+        data['vault'] = dict(previous)
+        if password is not None:
+            salt = os.urandom(16).hex()
+            data['vault'].update(salt=salt, password_hash=_hash_password(password, salt))
+        if verified:
+            data['vault']['last_verified'] = time.time()
+        with self.lock:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f".session_{username}.", suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path(username))
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+
+def _hash_password(password, salt):
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), bytes.fromhex(salt), 100_000).hex()
@@ -0,0 +1,81 @@
+from concurrent.futures import ProcessPoolExecutor
+import io
+import multiprocessing
+import threading
+
+# Every thumbnail is rendered at one of these widths, so each photo has at most this many variants
+THUMBNAIL_WIDTHS = (160, 320, 640)
+
+
+def snap_width(width):
+    """Smallest fixed width covering the requested one (the largest if none does)."""
+    for fixed in THUMBNAIL_WIDTHS:
+        if fixed >= width:
+            return fixed
+    return THUMBNAIL_WIDTHS[-1]
+
+
+def render_thumbnail(source_path, width, image_format):
+    """Scale the image at source_path down to width and return it encoded as image_format.
+
+    Runs in a worker process, so it only takes and returns picklable values.
+    """
+    from PIL import Image, ImageOps
+    with Image.open(source_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        if image_format == 'JPEG' and img.mode != 'RGB':
+            img = img.convert('RGB')
+        elif img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        out = io.BytesIO()
+        img.save(out, image_format, quality=80)
+        return out.getvalue()
+
+
+class ThumbnailRenderer:
+    """Renders thumbnails on a process pool so resizing never holds up request threads.
+
+    The pool and Pillow are only started on first use.
+    """
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.executor = None
+        self.webp = None
+        self.rendered = 0
+
+    def _start(self):
+        with self.lock:
+            if self.executor is None:
+                from PIL import features
+                self.webp = features.check('webp')
+                # Forking a process that runs threads (scheduler, socket workers) can copy a held lock
+                # into the child; workers start from a clean interpreter instead
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                    mp_context=multiprocessing.get_context(method))
+            return self.executor
+
+    def image_format(self, accept_webp):
+        """WebP when both the browser and Pillow support it, otherwise JPEG."""
+        self._start()
+        return 'WEBP' if accept_webp and self.webp else 'JPEG'
+
+    def render(self, source_path, width, image_format, timeout=None):
+        """Render a thumbnail in the pool and return its bytes."""
+        data = self._start().submit(render_thumbnail, source_path, width, image_format).result(timeout)
+        with self.lock:
+            self.rendered += 1
+        return data
+
+    def stats(self):
+        with self.lock:
+            return {
+                'rendered': self.rendered,
+                'workers': self.max_workers,
+                'webp': self.webp,
+                'widths': list(THUMBNAIL_WIDTHS),
+            }
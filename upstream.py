@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import threading
+
+
+class UpstreamTimeout(Exception):
+    """An upstream call did not finish (or could not start) within its timeout."""
+
+
+class UpstreamExecutor:
+    """Runs Instagram calls on a shared thread pool with per-account limits and timeouts.
+
+    Callers wait at most `timeout` seconds. A call that times out keeps
+    running, and its result goes to on_late (if given) once it arrives, so
+    the work is not wasted.
+    """
+
+    def __init__(self, max_workers=32, per_account=4, timeout=15):
+        self.per_account = per_account
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upstream')
+        self.lock = threading.Lock()
+        self.semaphores = {}  # account -> BoundedSemaphore
+        self.in_flight = 0
+        self.timeouts = 0
+
+    def _semaphore(self, account):
+        with self.lock:
+            semaphore = self.semaphores.get(account)
+            if semaphore is None:
+                semaphore = self.semaphores[account] = threading.BoundedSemaphore(self.per_account)
+            return semaphore
+
+    def submit(self, account, fn, *args, timeout=None, **kwargs):
+        """Start fn once the account has a free slot and return its Future."""
+        timeout = self.timeout if timeout is None else timeout
+        semaphore = self._semaphore(account)
+        if not semaphore.acquire(timeout=timeout):
+            with self.lock:
+                self.timeouts += 1
+            raise UpstreamTimeout(f"{account} already has {self.per_account} upstream calls in flight")
+        with self.lock:
+            self.in_flight += 1
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._finished(semaphore)
+            raise
+        future.add_done_callback(lambda f: self._finished(semaphore))
+        return future
+
+    def _finished(self, semaphore):
+        semaphore.release()
+        with self.lock:
+            self.in_flight -= 1
+
+    def call(self, account, fn, *args, timeout=None, on_late=None, **kwargs):
+        """Run fn for account and return its result, raising UpstreamTimeout if it is too slow."""
+        timeout = self.timeout if timeout is None else timeout
+        future = self.submit(account, fn, *args, timeout=timeout, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            with self.lock:
+                self.timeouts += 1
+            if on_late:
+                future.add_done_callback(
+                    lambda f: on_late(f.result()) if not f.cancelled() and f.exception() is None else None)
+            raise UpstreamTimeout(f"Upstream call for {account} took longer than {timeout}s")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': self.in_flight,
+                'timeouts': self.timeouts,
+                'per_account': self.per_account,
+                'timeout': self.timeout,
+            }